@@ -3,7 +3,11 @@ r'''dfbuilder -- Backend for dataframe builder i2b2 plugin
 
 Usage:
 
-   $ python cdr2edc.dfbuilder db_and_output.conf job_info.json
+   $ python cdr2edc.dfbuilder db_and_output.conf job_info.json...
+
+Jobs given together share one scan of `observation_fact`; see
+:py:meth:`BuilderApp.batch`. With a ``batch_window`` (below), jobs
+queued within that many seconds of each other are run together.
 
 
 i2b2 Clinical Data Repository
@@ -55,6 +59,28 @@ extract configuration file:
     ...     '/job1.json': json.dumps(job_info)
     ... })
 
+Optional settings in the ``[output]`` section:
+
+  - ``concurrent_export``: run the demographics, term and fact
+    queries in parallel on separate CDW connections.
+  - ``pipelined_copy``: fetch from the CDW and write to the output
+    in separate threads (see :py:func:`copy_pipelined`).
+  - ``sql_cache``: file in which to keep compiled SQL across runs
+    (see :py:class:`SQLCache`).
+  - ``compress``: ``gzip`` or ``zstd``; package each finished extract
+    with a checksum and manifest (see :py:func:`package_extract`).
+  - ``remove_uncompressed``: once the compressed copy is checked
+    against the checksum, remove the uncompressed file, to save
+    users' disk quota; the extract reader then can't serve it.
+  - ``shards``: split patients across this many SQLite files
+    (see :py:class:`ShardedDest`).
+  - ``variable_stats``: describe the values of each variable in a
+    `variable_stats` table and the completion email
+    (see :py:class:`VariableStats`).
+  - ``batch_window``: seconds to wait for more requests to queue up
+    next to this one before running them all together
+    (see :py:class:`RequestQueue`).
+
     >>> result_db = i2b2_project_mock.in_memory_db()
 
     >>> def _create_engine(url):
@@ -66,7 +92,7 @@ The parameters (config, filename) come in via the command-line:
 The SMTP capability (for tests we have the quiet version - no print)
     >>> def sendmailquiet(sender, receiver, msg):
     ...     pass
-    >>> mocksmtp = MockSMTP()
+    >>> mocksmtp = emailer.MockSMTP()
     >>> mocksmtp.sendmail = sendmailquiet
 
 Then `_trusted_main()` gets access to I/O and the database and such
@@ -130,6 +156,15 @@ asked for:
     u'ED Vitals'
 
 
+Profiling
+---------
+
+To find out after the fact why a job was slow or used a lot of
+memory, set the ``DFBUILD_PROFILE`` environment variable (e.g. to
+``cprofile`` or ``phases``) or the options of the same names in a
+``[profile]`` config section; see :py:class:`JobProfiler`.
+
+
 Design Note
 -----------
 
@@ -142,31 +177,75 @@ API
 
 '''
 
+import time
+_loaded_at = time.time()
+
+import gzip
+import hashlib
+import importlib
 import json
 import logging
+import marshal
 import re
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from ConfigParser import NoOptionError, NoSectionError
+from Queue import Full, Queue
+from threading import Lock, Thread
 
 from sqlalchemy import Table, Column, types
+from sqlalchemy import __version__ as sqla_version
 from sqlalchemy import select, and_
 from sqlalchemy.engine.url import URL as DBURL
 from sqlalchemy.schema import MetaData
-from sqlalchemy.sql import bindparam, func
+from sqlalchemy.sql import bindparam, func, text
 from sqlalchemy.exc import OperationalError
 
 from ocap import lafile
-from emailer import Emailer
-from emailer import MockSMTP
-
-import sqla_float_date as fd
-import i2b2_star
-import table_copy as tc
 
 from os.path import isdir
 import errno
 
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+
+__version__ = '1.1'  # bump when generated SQL changes; see SQLCache
+
+_first_query_at = None  # see SQLCache.execute
 
 log = logging.getLogger('dfbuilder')
 
+
+class LazyModule(object):
+    '''Import a module when one of its attributes is first used.
+
+    >>> json_ = LazyModule('json')
+    >>> json_.dumps([1])
+    '[1]'
+    '''
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            t0 = time.time()
+            self._module = importlib.import_module(self._name)
+            log.debug('imported %s in %.3fs', self._name, time.time() - t0)
+        return getattr(self._module, attr)
+
+
+# These are only needed by some phases of a job; don't make every
+# job pay to load them at startup.
+emailer = LazyModule('emailer')
+fd = LazyModule('sqla_float_date')
+i2b2_star = LazyModule('i2b2_star')
+tc = LazyModule('table_copy')
+
 classOf = lambda cls: cls  # scala_hide
 typed = lambda x, t: x  # scala_hide
 
@@ -178,6 +257,10 @@ class DataExtract(object):
 
     drivername = 'oracle+cx_oracle'
 
+    window_dialects = ('oracle', 'postgresql', 'mssql')
+
+    filter_keys = ('start_date', 'end_date', 'latest_n', 'numeric_only')
+
     data_tables = ['patient_dimension',
                    'visit_dimension',
                    'concept_dimension',
@@ -193,49 +276,112 @@ class DataExtract(object):
             (k, v) for (k, v) in cdw_opts if k != DB_KEY)))
 
     def __init__(self, account, user_id,
-                 label, concepts, patient_set, filename):
+                 label, concepts, patient_set, filename,
+                 filters=None, sql_cache=None):
+        '''
+        :param patient_set: patient set id, or a list of them; concepts
+                            are resolved and facts scanned just once
+                            for all of the sets.
+        :param filters: optional restrictions on facts; see
+                        :py:meth:`filter_binds`
+        :param sql_cache: a :py:class:`SQLCache` to compile queries with
+        '''
+        sql_cache = sql_cache or SQLCache.disabled()
+        patient_sets = (patient_set if isinstance(patient_set, list)
+                        else [patient_set])
+        n_sets = len(patient_sets)
+        sets_label = ', '.join('#%d' % ps for ps in patient_sets)
+
         # TODO: make these read-only properties
         self.user_id = user_id
         self.label = label
         self.concepts = concepts
-        self.patient_set = patient_set
+        self.patient_set = patient_sets[0]
+        self.patient_sets = patient_sets
         self.filename = filename
+        self.filters = filters = dict(
+            (k, v) for (k, v) in (filters or {}).items() if v)
 
         concept_keys = concepts['keys']
-
-        def demographics():
-            log.info('getting demographics for patient set #%d', patient_set)
-            pat_q, enc_q = self.patients_query('result_instance_id')
-            return [(pat_q, account.execute(pat_q,
-                                            result_instance_id=patient_set)),
-                    (enc_q, account.execute(enc_q,
-                                            result_instance_id=patient_set))]
+        self.redundant = DataExtract.redundant_paths(
+            I2B2MetaData.keys_to_paths(concept_keys))
+
+        # Each phase runs on `account` unless given its own connection
+        # (see `connect`), so that phases can run concurrently.
+        def connect():
+            return account.connect()
+        self.connect = connect
+
+        def demographics(db=account):
+            log.info('getting demographics for patient set(s) %s', sets_label)
+            window = DataExtract.supports_window(db.dialect)
+
+            def queries():
+                return self.patients_query(
+                    'result_instance_id',
+                    window=window, n_sets=n_sets) + (
+                        self.cohort_query('result_instance_id', n_sets),)
+            binds = self.patient_set_binds('result_instance_id',
+                                           patient_sets)
+            return [sql_cache.execute(
+                db, 'demographics/%d/%s/%d' % (n_sets, window, ix),
+                lambda ix=ix: queries()[ix], **binds)
+                for ix in range(3)]
         self.demographics = demographics
 
-        def term_info():
+        def term_info(db=account):
             log.info('getting term info for %d paths', len(concept_keys))
             tmp, ins, bind = DataExtract._save_concepts(concepts)
-            account.execute(tmp.delete())
+            db.execute(tmp.delete())
             if len(bind) > 0:
-                account.execute(ins, bind)
-            ordered = [q.order_by(col)
-                       for (q, col) in self._term_query(tmp)]
-            return [(q, account.execute(q))
-                    for q in ordered]
+                sql_cache.execute(db, 'save_concepts', lambda: ins, bind)
+
+            def ordered():
+                return [q.order_by(col)
+                        for (q, col) in self._term_query(tmp)]
+            return [sql_cache.execute(db, 'term_info/%d' % ix,
+                                      lambda ix=ix: ordered()[ix])
+                    for ix in range(2)]
         self.term_info = term_info
 
-        def patient_data():
-            log.info('getting patient data for patient set %d', patient_set)
+        def patient_data(db=account):
+            log.info('getting patient data for patient set(s) %s',
+                     sets_label)
             var_tmp, var_ins, var_bind = DataExtract._save_concepts(concepts)
-            account.execute(var_tmp.delete())
+            db.execute(var_tmp.delete())
             if len(var_bind) > 0:
-                account.execute(var_ins, var_bind)
-            code_tmp, ins, sel = DataExtract.patient_data_queries(var_tmp)
-            account.execute(code_tmp.delete())
-            account.execute(ins)
-            return sel, account.execute(sel, id=patient_set)
+                sql_cache.execute(db, 'save_concepts',
+                                  lambda: var_ins, var_bind)
+            window = DataExtract.supports_window(db.dialect)
+
+            def queries():
+                return DataExtract.patient_data_queries(
+                    var_tmp, n_sets=n_sets, filters=filters, window=window)
+            code_tmp = i2b2_star.t_query_global_temp
+            db.execute(code_tmp.delete())
+            key = 'patient_data/%d/%s/%s' % (n_sets, window,
+                                             ','.join(sorted(filters)))
+            sql_cache.execute(db, key + '/ins', lambda: queries()[1])
+            binds = DataExtract.patient_set_binds('id', patient_sets)
+            binds.update(DataExtract.filter_binds(filters))
+            return sql_cache.execute(db, key + '/sel',
+                                     lambda: queries()[2], **binds)
         self.patient_data = patient_data
 
+        def merge(others):
+            '''Extract the concepts and patient sets of this and other
+            jobs, which must have the same filters, together.
+            '''
+            keys, patient_sets = [], []
+            for job in [self] + others:
+                keys.extend(k for k in job.concepts['keys'] if k not in keys)
+                patient_sets.extend(ps for ps in job.patient_sets
+                                    if ps not in patient_sets)
+            return DataExtract(account, user_id, 'batch of %d jobs' % (
+                len(others) + 1), dict(keys=keys, names=keys),
+                patient_sets, filename, filters, sql_cache)
+        self.merge = merge
+
     @classmethod
     def copy_star_schema(cls, bind=None):
         m = MetaData()
@@ -246,8 +392,12 @@ class DataExtract(object):
         return m
 
     @classmethod
-    def patient_data_queries(cls, tmp):
+    def patient_data_queries(cls, tmp,
+                             n_sets=1, filters={}, window=False):
         '''
+        :param filters: keys of restrictions to apply; values are bound
+                        at execution time (see :py:meth:`filter_binds`)
+        :param window: use ``ROW_NUMBER()`` to pick the latest facts
         >>> var_tmp = i2b2_star.t_global_temp_fact_param_table
         >>> code_tmp, ins, sel = DataExtract.patient_data_queries(var_tmp)
 
@@ -278,6 +428,68 @@ class DataExtract(object):
           ON pset.patient_num = f.patient_num
         WHERE pset.result_instance_id = :id
 
+        Facts for patients in several sets come out just once:
+
+        >>> _, _, sel = DataExtract.patient_data_queries(var_tmp, n_sets=2)
+        >>> print sel
+        ... # doctest: +NORMALIZE_WHITESPACE +ELLIPSIS
+        SELECT f.encounter_num, f.patient_num, f.concept_cd, ...
+        FROM observation_fact AS f
+        JOIN query_global_temp
+          ON f.concept_cd = query_global_temp.concept_cd
+        JOIN (SELECT DISTINCT psc.patient_num AS patient_num
+              FROM qt_patient_set_collection AS psc
+              WHERE psc.result_instance_id IN (:id_0, :id_1)) AS pset
+          ON pset.patient_num = f.patient_num
+
+        Filters narrow the facts in the CDW rather than after transfer:
+
+        >>> filters = dict(start_date='2010-01-01', numeric_only=True)
+        >>> _, _, sel = DataExtract.patient_data_queries(var_tmp,
+        ...                                              filters=filters)
+        >>> print sel
+        ... # doctest: +NORMALIZE_WHITESPACE +ELLIPSIS
+        SELECT f.encounter_num, f.patient_num, f.concept_cd, ...
+        FROM observation_fact AS f ...
+        WHERE pset.result_instance_id = :id
+          AND f.start_date >= :start_date
+          AND f.valtype_cd = :valtype_cd_1
+
+        The latest N facts per patient per concept (and modifier) are
+        ranked with a window function where available:
+
+        >>> _, _, sel = DataExtract.patient_data_queries(
+        ...     var_tmp, filters=dict(latest_n=3), window=True)
+        >>> print sel
+        ... # doctest: +NORMALIZE_WHITESPACE +ELLIPSIS
+        SELECT ranked.encounter_num, ranked.patient_num, ...
+        FROM (SELECT f.encounter_num AS encounter_num, ...
+                     row_number() OVER (PARTITION BY f.patient_num,
+                                                     f.concept_cd,
+                                                     f.modifier_cd
+                                        ORDER BY f.start_date DESC,
+                                                 f.encounter_num DESC,
+                                                 f.instance_num DESC)
+                       AS fact_rank
+              FROM observation_fact AS f ...
+              WHERE pset.result_instance_id = :id) AS ranked
+        WHERE ranked.fact_rank <= :latest_n
+
+        and otherwise by counting later facts:
+
+        >>> _, _, sel = DataExtract.patient_data_queries(
+        ...     var_tmp, filters=dict(latest_n=3))
+        >>> print sel
+        ... # doctest: +NORMALIZE_WHITESPACE +ELLIPSIS
+        SELECT f.encounter_num, f.patient_num, f.concept_cd, ...
+        WHERE pset.result_instance_id = :id
+          AND (SELECT count(*) AS count_1
+               FROM observation_fact AS later
+               WHERE later.patient_num = f.patient_num
+                 AND later.concept_cd = f.concept_cd
+                 AND later.modifier_cd = f.modifier_cd
+                 AND later.start_date > f.start_date) < :latest_n
+
         '''
         [(tq_sql, _sortcol), _modifier_stuff] = cls._term_query(tmp)
 
@@ -288,22 +500,206 @@ class DataExtract(object):
                    select([tq_sql.alias('tq').c.concept_cd]).distinct()))
 
         f = i2b2_star.t_observation_fact.alias('f')
-        pset = i2b2_star.t_qt_patient_set_collection.alias('pset')
-
-        s_facts = (select([f])
-                   #@@.with_hint(f, '+ index(%(name)s, OBS_FACT_CON_CODE_BI)')
-                   .select_from(
-                       f.join(code_tmp,
-                              f.c.concept_cd == code_tmp.c.concept_cd)
-                       .join(pset,
-                             pset.c.patient_num == f.c.patient_num))
-                   .where(pset.c.result_instance_id == bindparam("id")))
+        pset, in_sets = cls._patient_set('id', n_sets)
+
+        latest_n = bindparam('latest_n', type_=types.Integer)
+        fact_rank = (
+            func.row_number()
+            .over(partition_by=[f.c.patient_num, f.c.concept_cd,
+                                f.c.modifier_cd],
+                  order_by=[f.c.start_date.desc(),
+                            f.c.encounter_num.desc(),
+                            f.c.instance_num.desc()])
+            .label('fact_rank'))
+        ranking = 'latest_n' in filters and window
+
+        s_facts = in_sets(
+            select([f, fact_rank] if ranking else [f])
+            #@@.with_hint(f, '+ index(%(name)s, OBS_FACT_CON_CODE_BI)')
+            .select_from(
+                f.join(code_tmp,
+                       f.c.concept_cd == code_tmp.c.concept_cd)
+                .join(pset,
+                      pset.c.patient_num == f.c.patient_num)))
+        for criterion in cls._fact_criteria(f, filters):
+            s_facts = s_facts.where(criterion)
+
+        if ranking:
+            ranked = s_facts.alias('ranked')
+            s_facts = (
+                select([ranked.c[col.name] for col in f.columns])
+                .where(ranked.c.fact_rank <= latest_n))
+        elif 'latest_n' in filters:
+            # Ties on start_date may yield more than N facts.
+            later = i2b2_star.t_observation_fact.alias('later')
+            n_later = (
+                select([func.count()])
+                .where(and_(*[later.c.patient_num == f.c.patient_num,
+                              later.c.concept_cd == f.c.concept_cd,
+                              later.c.modifier_cd == f.c.modifier_cd,
+                              later.c.start_date > f.c.start_date] +
+                            cls._fact_criteria(later, filters)))
+                .as_scalar())
+            s_facts = s_facts.where(n_later < latest_n)
 
         return code_tmp, ins, s_facts
 
     @classmethod
-    def patients_query(cls, bind):
+    def _fact_criteria(cls, f, filters):
+        criteria = []
+        if 'start_date' in filters:
+            criteria.append(f.c.start_date >= bindparam(
+                'start_date', type_=types.DateTime))
+        if 'end_date' in filters:
+            criteria.append(f.c.start_date < bindparam(
+                'end_date', type_=types.DateTime))
+        if filters.get('numeric_only'):
+            criteria.append(f.c.valtype_cd == 'N')
+        return criteria
+
+    @classmethod
+    def check_filters(cls, filters):
+        '''Check fact filters from a job request before running it.
+
+        >>> DataExtract.check_filters(dict(start_date='2010-13-45'))
+        Traceback (most recent call last):
+          ...
+        ValueError: bad filter: time data '2010-13-45' does not match format '%Y-%m-%d'
+        >>> DataExtract.check_filters(dict(start_date='2010-02-01',
+        ...                                end_date='2010-01-31'))
+        Traceback (most recent call last):
+          ...
+        ValueError: start_date 2010-02-01 is after end_date 2010-01-31
+        >>> DataExtract.check_filters(dict(latest_n='0'))
+        Traceback (most recent call last):
+          ...
+        ValueError: latest_n must be at least 1
+        >>> DataExtract.check_filters(dict(start_date='2010-01-31',
+        ...                                end_date='2010-01-31'))
+
+        :raises ValueError: with a message for the user
+        '''
+        try:
+            binds = cls.filter_binds(filters)
+        except ValueError as ex:
+            raise ValueError('bad filter: %s' % ex)
+        if binds.get('latest_n', 1) < 1:
+            raise ValueError('latest_n must be at least 1')
+        if ('start_date' in binds and 'end_date' in binds and
+                binds['start_date'] >= binds['end_date']):
+            raise ValueError('start_date %s is after end_date %s' % (
+                filters['start_date'], filters['end_date']))
+
+    @classmethod
+    def filter_binds(cls, filters,
+                     date_format='%Y-%m-%d'):
+        '''Bind values for fact filters from a job request.
+
+        Dates are inclusive; `end_date` is bound to the start of the
+        following day:
+
+        >>> filters = dict(start_date='2010-01-01', end_date='2010-12-31',
+        ...                latest_n='3', numeric_only=True)
+        >>> for k, v in sorted(DataExtract.filter_binds(filters).items()):
+        ...     print k, v
+        end_date 2011-01-01 00:00:00
+        latest_n 3
+        start_date 2010-01-01 00:00:00
+        '''
+        binds = {}
+        if 'start_date' in filters:
+            binds['start_date'] = datetime.strptime(
+                filters['start_date'], date_format)
+        if 'end_date' in filters:
+            binds['end_date'] = datetime.strptime(
+                filters['end_date'], date_format) + timedelta(days=1)
+        if 'latest_n' in filters:
+            binds['latest_n'] = int(filters['latest_n'])
+        return binds
+
+    @classmethod
+    def supports_window(cls, dialect):
+        '''Can we use ``ROW_NUMBER() OVER (...)`` with this dialect?
+
+        >>> from sqlalchemy.dialects import oracle, sqlite
+        >>> DataExtract.supports_window(oracle.dialect())
+        True
+
+        SQLite only has window functions as of 3.25:
+
+        >>> DataExtract.supports_window(sqlite.dialect())
+        False
+        '''
+        if dialect.name == 'sqlite':
+            version = getattr(dialect.dbapi, 'sqlite_version_info', (0,))
+            return version >= (3, 25)
+        return dialect.name in cls.window_dialects
+
+    @classmethod
+    def _patient_set(cls, bind, n_sets):
+        '''Patients in one or more patient sets.
+
+        :param bind: name of the patient set id parameter(s); see
+                     :py:meth:`patient_set_binds`
+        :return: (pset, in_sets) where `pset` has a `patient_num` column
+                 to join with and `in_sets(q)` restricts `q` to the sets
+        '''
+        psc = i2b2_star.t_qt_patient_set_collection
+        if n_sets == 1:
+            pset = psc.alias('pset')
+            patient_set = bindparam(bind, type_=types.Integer)
+            return pset, lambda q: q.where(
+                pset.c.result_instance_id == patient_set)
+
+        psc = psc.alias('psc')
+        pset = (select([psc.c.patient_num]).distinct()
+                .where(psc.c.result_instance_id.in_(
+                    [bindparam('%s_%d' % (bind, ix), type_=types.Integer)
+                     for ix in range(n_sets)]))).alias('pset')
+        return pset, lambda q: q
+
+    @classmethod
+    def patient_set_binds(cls, bind, patient_sets):
+        '''Bind patient set id(s) for queries from :py:meth:`_patient_set`.
+
+        >>> DataExtract.patient_set_binds('id', [123])
+        {'id': 123}
+        >>> sorted(DataExtract.patient_set_binds('id', [123, 456]).items())
+        [('id_0', 123), ('id_1', 456)]
+        '''
+        if len(patient_sets) == 1:
+            return {bind: patient_sets[0]}
+        return dict(('%s_%d' % (bind, ix), ps)
+                    for (ix, ps) in enumerate(patient_sets))
+
+    @classmethod
+    def cohort_query(cls, bind, n_sets=1):
+        '''Which patients are in which of the requested patient sets?
+
+        >>> print DataExtract.cohort_query('result_instance_id', n_sets=2)
+        ... # doctest: +NORMALIZE_WHITESPACE
+        SELECT psc.result_instance_id AS pset, psc.patient_num
+        FROM qt_patient_set_collection AS psc
+        WHERE psc.result_instance_id
+              IN (:result_instance_id_0, :result_instance_id_1)
+        '''
+        psc = i2b2_star.t_qt_patient_set_collection.alias('psc')
+        ids = [bindparam(bind, type_=types.Integer)] if n_sets == 1 else [
+            bindparam('%s_%d' % (bind, ix), type_=types.Integer)
+            for ix in range(n_sets)]
+        return (select([psc.c.result_instance_id.label('pset'),
+                        psc.c.patient_num])
+                .where(psc.c.result_instance_id.in_(ids)))
+
+    @classmethod
+    def patients_query(cls, bind,
+                       window=False, n_sets=1):
         '''
+        :param window: pick each patient's last visit in one pass with
+                       ``ROW_NUMBER()``; otherwise use nested aggregates,
+                       which work on any backend.
+        :param n_sets: number of patient sets; see :py:meth:`_patient_set`
+
         >>> pat_q, enc_q = DataExtract.patients_query('result_instance_id')
 
         >>> print pat_q
@@ -336,30 +732,75 @@ class DataExtract(object):
             AND vd.start_date = last.last_visit
            GROUP BY vd.patient_num) AS arb_visit
         ON vd.encounter_num = arb_visit.encounter_num
-        '''
-        patient_set = bindparam(bind, type_=types.Integer)
 
-        pset = i2b2_star.t_qt_patient_set_collection.alias('pset')
+        The window function variant scans `visit_dimension` once,
+        breaking ties on `start_date` by `encounter_num`, just as above:
+
+        >>> _, enc_q = DataExtract.patients_query('result_instance_id',
+        ...                                       window=True)
+        >>> print enc_q
+        ... # doctest: +NORMALIZE_WHITESPACE +ELLIPSIS
+        SELECT ranked.encounter_num, ranked.patient_num, ...
+        FROM
+          (SELECT vd.encounter_num AS encounter_num,
+                  vd.patient_num AS patient_num, ...
+                  row_number() OVER (PARTITION BY vd.patient_num
+                                     ORDER BY vd.start_date DESC,
+                                              vd.encounter_num DESC)
+                    AS visit_rank
+           FROM visit_dimension AS vd
+           JOIN patient_dimension AS pd
+             ON pd.patient_num = vd.patient_num
+           JOIN qt_patient_set_collection AS pset
+             ON pset.patient_num = pd.patient_num
+           WHERE pset.result_instance_id = :result_instance_id
+             AND vd.start_date IS NOT NULL) AS ranked
+        WHERE ranked.visit_rank = :visit_rank_1
+        '''
+        pset, in_sets = cls._patient_set(bind, n_sets)
         pd = i2b2_star.t_patient_dimension.alias('pd')
         vd = i2b2_star.t_visit_dimension.alias('vd')
 
-        pat_q = (
+        pat_q = in_sets(
             select([pd])
             .select_from(
                 pd
                 .join(pset,
-                      pset.c.patient_num == pd.c.patient_num))
-            .where(pset.c.result_instance_id == patient_set))
+                      pset.c.patient_num == pd.c.patient_num)))
+
+        if window:
+            # max(start_date) skips nulls, so rank only dated visits
+            visit_rank = (
+                func.row_number()
+                .over(partition_by=vd.c.patient_num,
+                      order_by=[vd.c.start_date.desc(),
+                                vd.c.encounter_num.desc()])
+                .label('visit_rank'))
+            ranked = (
+                in_sets(
+                    select([vd, visit_rank])
+                    .select_from(
+                        vd
+                        .join(pd, pd.c.patient_num == vd.c.patient_num)
+                        .join(pset,
+                              pset.c.patient_num == pd.c.patient_num)))
+                .where(vd.c.start_date.isnot(None))).alias('ranked')
+
+            enc_q = (
+                select([ranked.c[col.name] for col in vd.columns])
+                .where(ranked.c.visit_rank == 1))
+
+            return pat_q, enc_q
 
         last = (
-            select([vd.c.patient_num,
-                    func.max(vd.c.start_date).label('last_visit')])
-            .select_from(
-                vd
-                .join(pd, pd.c.patient_num == vd.c.patient_num)
-                .join(pset,
-                      pset.c.patient_num == pd.c.patient_num))
-            .where(pset.c.result_instance_id == patient_set)
+            in_sets(
+                select([vd.c.patient_num,
+                        func.max(vd.c.start_date).label('last_visit')])
+                .select_from(
+                    vd
+                    .join(pd, pd.c.patient_num == vd.c.patient_num)
+                    .join(pset,
+                          pset.c.patient_num == pd.c.patient_num)))
             .group_by(vd.c.patient_num)).alias('last')
 
         arb_visit = (
@@ -449,17 +890,205 @@ class DataExtract(object):
         >>> sorted(bind[0].values())
         ['\\a', 'apples']
 
+        Only paths not covered by others are saved:
+
+        >>> concepts = dict(
+        ...     names=['fruit', 'apples', 'fruit again'],
+        ...     keys=['\\\\tk\\fruit\\', '\\\\tk\\fruit\\apples\\',
+        ...           '\\\\tk\\fruit\\'])
+        >>> tmp, ins, bind = DataExtract._save_concepts(concepts)
+        >>> [b['name'] for b in bind]
+        ['fruit']
+
         '''
         names = concepts['names']
         paths = I2B2MetaData.keys_to_paths(concepts['keys'])
+        redundant = cls.redundant_paths(paths)
         bind = [dict(name=name,
                      path=path)
-                for (path, name) in zip(paths, names)]
+                for (path, name, covered) in zip(paths, names, redundant)
+                if not covered]
+        if len(bind) < len(paths):
+            log.info('pruned %d redundant concept paths',
+                     len(paths) - len(bind))
         tmp = i2b2_star.t_global_temp_fact_param_table
         ins = tmp.insert().values(char_param1=bindparam('path'),
                                   char_param2=bindparam('name'))
         return tmp, ins, bind
 
+    @classmethod
+    def redundant_paths(cls, paths):
+        r'''Which paths are covered by another path, as by a LIKE prefix?
+
+        Sorting puts each path right after any that it starts with, so
+        one pass finds the minimal set of prefixes. Of identical paths,
+        the first is kept.
+
+        >>> DataExtract.redundant_paths(
+        ...     ['\\a\\b\\', '\\a\\', '\\c\\', '\\a\\', '\\ab\\'])
+        [True, False, False, True, False]
+
+        :return: for each path, whether it is redundant
+        '''
+        redundant = [False] * len(paths)
+        kept = None
+        for (path, ix) in sorted((path, ix) for (ix, path) in enumerate(paths)):
+            if kept is not None and path.startswith(kept):
+                redundant[ix] = True
+            else:
+                kept = path
+        return redundant
+
+
+class SQLCache(object):
+    '''Compiled SQL statements, kept across runs.
+
+    Compiling our queries for Oracle takes a noticeable share of a
+    small job, and the result only depends on the dialect, the
+    SQLAlchemy version and this module's :py:data:`__version__`,
+    which together with a statement name make up the cache key.
+    Result columns are matched to the compiled text by position, so
+    an entry is also checked against the statement's column names.
+
+    Compiled text is run as-is, so only dialects with named
+    parameters (such as Oracle's) are cached:
+
+    >>> from sqlalchemy import create_engine
+    >>> db = create_engine('sqlite://', paramstyle='named')
+
+    >>> saved = {}
+    >>> cache = SQLCache(lambda: dict(saved), saved.update)
+    >>> answer = lambda: select([bindparam('x') + 1])
+    >>> q, result = cache.execute(db, 'answer', answer, x=41)
+    >>> result.scalar()
+    42
+    >>> [k.split(' ', 3)[3] for k in saved.keys()]
+    ['answer']
+
+    Next time, we build the statement but don't compile it:
+
+    >>> cache = SQLCache(lambda: dict(saved), saved.update)
+    >>> q, result = cache.execute(db, 'answer', answer, x=1)
+    >>> print q, result.scalar()
+    SELECT :x + :param_1 AS anon_1 2
+
+    The statement's result columns carry over, so a hit gets the same
+    type processing as a miss:
+
+    >>> from datetime import datetime
+    >>> stamp = lambda: select([
+    ...     func.datetime(bindparam('t'), type_=types.DateTime).label('t')])
+    >>> for _ in range(2):
+    ...     cache = SQLCache(lambda: dict(saved), saved.update)
+    ...     q, result = cache.execute(db, 'stamp', stamp, t='2010-01-02')
+    ...     print repr(result.scalar())
+    datetime.datetime(2010, 1, 2, 0, 0)
+    datetime.datetime(2010, 1, 2, 0, 0)
+
+    An entry whose columns no longer match the statement (say, after
+    a change to the schema without a new :py:data:`__version__`) is
+    compiled again:
+
+    >>> answers = lambda: select([bindparam('x').label('a'),
+    ...                           bindparam('x').label('b')])
+    >>> cache = SQLCache(lambda: dict(saved), saved.update)
+    >>> q, result = cache.execute(db, 'answer', answers, x=7)
+    >>> result.fetchall()
+    [(7, 7)]
+
+    A disabled cache just builds and runs the statement:
+
+    >>> q, result = SQLCache.disabled().execute(
+    ...     db, 'answer', lambda: select([bindparam('x') + 1]), x=2)
+    >>> result.scalar()
+    3
+    '''
+    def __init__(self, load, save):
+        self._load = load
+        self._save = save
+        self._entries = None
+        self._lock = Lock()
+
+    @classmethod
+    def disabled(cls):
+        return cls(None, None)
+
+    @classmethod
+    def on(cls, store, os, openf):
+        '''Keep the cache as JSON in `store`, an lafile.Editable.
+
+        Jobs may share `store`, so it is replaced by renaming a
+        complete new copy, which includes entries saved since we
+        loaded it.
+
+        :param os: for `rename` and `getpid`
+        :param openf: to write the new copy next to `store`
+        '''
+        def load():
+            try:
+                return json.load(store.ro().inChannel())
+            except (IOError, ValueError) as ex:
+                log.info('no SQL cache in %s: %s', store.ro().fullPath(), ex)
+                return {}
+
+        def save(entries):
+            path = store.ro().fullPath()
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            out = openf(tmp, 'w')
+            try:
+                json.dump(dict(load(), **entries), out)
+            finally:
+                out.close()
+            os.rename(tmp, path)
+
+        return cls(load, save)
+
+    def execute(self, db, name, build, *multiparams, **params):
+        '''Execute the statement from `build()` on `db`.
+
+        :return: the statement (or its compiled text) and the result
+        '''
+        global _first_query_at
+        if _first_query_at is None:
+            # i.e. startup, including deferred imports, and compiling
+            _first_query_at = time.time()
+            log.info('first CDW query %.3fs after startup',
+                     _first_query_at - _loaded_at)
+        if self._load is None or db.dialect.positional:
+            q = build()
+            return q, db.execute(q, *multiparams, **params)
+
+        sql, defaults = self._compiled(db.dialect, name, build)
+        if multiparams:
+            [rows] = multiparams
+            return sql, db.execute(sql, [dict(defaults, **row)
+                                         for row in rows])
+        return sql, db.execute(sql, dict(defaults, **params))
+
+    def _compiled(self, dialect, name, build):
+        key = '%s %s %s %s' % (__version__, sqla_version, dialect.name, name)
+        q = build()
+        columns = list(getattr(q, 'columns', []))
+        names = [col.name for col in columns]
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            entry = self._entries.get(key)
+            if entry is None or entry.get('columns') != names:
+                compiled = q.compile(dialect=dialect)
+                entry = dict(sql=unicode(compiled),
+                             params=dict((k, v)
+                                         for (k, v) in compiled.params.items()
+                                         if v is not None),
+                             columns=names)
+                self._entries[key] = entry
+                self._save(self._entries)
+        sql = text(entry['sql'])
+        if columns:
+            # so results get the same type processing
+            sql = sql.columns(*columns)
+        return sql, entry['params']
+
 
 class I2B2MetaData(object):
     @classmethod
@@ -513,22 +1142,121 @@ class DataDest(object):
     ... # doctest: +NORMALIZE_WHITESPACE
     [('filename', '/home/me/heron/job1.db'),
      ('id', 123),
-     ('n_patient', 5)]
+     ('n_patient', 5),
+     ('patient_sets', [123])]
+
+    The `job` table records all of the patient sets (`pset` is the first):
+
+    >>> dest_db.execute('select pset, psets from job').fetchall()
+    [(123, u'[123]')]
+
+    Its `finished` time is set last, so readers can tell the extract
+    is complete:
+
+    >>> dest_db.execute('select finished is not null from job').scalar()
+    1
 
     >>> print out['str']
     ... # doctest: +NORMALIZE_WHITESPACE
     Variable                                 N. Patient    N. Obs.
     n1                                                5        116
     n2                                                5        116
+
+    With `concurrent=True`, the demographics, term and fact queries
+    start at once, each on its own CDW connection; writes to the
+    destination still happen one at a time, as each result is ready.
+    Each connection needs temporary tables of its own, as with Oracle's
+    global temporary tables; to try it with SQLite, we copy the CDW to
+    a file and give each connection its own temp tables:
+
+    >>> import os, tempfile
+    >>> from sqlalchemy import create_engine, event
+    >>> from sqlalchemy.schema import CreateTable
+    >>> cdw_file = create_engine('sqlite:///' + os.path.join(
+    ...     tempfile.mkdtemp(), 'cdw.db'),
+    ...     connect_args=dict(check_same_thread=False))
+    >>> def temp_tables(dbapi_conn, _record):
+    ...     for t in [i2b2_star.t_global_temp_fact_param_table,
+    ...               i2b2_star.t_query_global_temp]:
+    ...         ddl = str(CreateTable(t).compile(dialect=cdw_file.dialect))
+    ...         dbapi_conn.execute(ddl.replace('CREATE', 'CREATE TEMP', 1))
+    >>> event.listen(cdw_file, 'connect', temp_tables)
+    >>> for name in DataExtract.data_tables + ['qt_patient_set_collection']:
+    ...     t = i2b2_star.metadata.tables[name]
+    ...     t.create(bind=cdw_file)
+    ...     rows = [dict(row) for row in cdw.execute(t.select())]
+    ...     if rows:
+    ...         _ = cdw_file.execute(t.insert(), rows)
+
+    >>> job = DataExtract(cdw_file, 'me',
+    ...                   'Interesting Query', concepts, 123, 'job1.db')
+    >>> out_c = DataDest(in_memory_db(), '/home/me/heron/job1.db',
+    ...                  concurrent=True).export(job)
+    >>> out_c['str'] == out['str'], out_c['n_patient']
+    (True, 5)
+
+    If a CDW connection can't be opened, the export fails rather than
+    waiting for it:
+
+    >>> opened = []
+    >>> def connect():
+    ...     opened.append(1)
+    ...     if len(opened) == 2:
+    ...         raise IOError('too many connections')
+    ...     return cdw_file.connect()
+    >>> job.connect = connect
+    >>> DataDest(in_memory_db(), '/home/me/heron/job1.db',
+    ...          concurrent=True).export(job)
+    Traceback (most recent call last):
+      ...
+    IOError: too many connections
+
+    A variable whose path is a duplicate of another, or nested under it,
+    is still listed, but marked `redundant`; its facts are found by the
+    other's query:
+
+    >>> concepts = dict(keys=[r'\\\\tk\\k1', r'\\\\tk\\k1\\x1',
+    ...                       r'\\\\tk\\k2', r'\\\\tk\\k1'],
+    ...                 names=['n1', 'n1 x1', 'n2', 'n1 again'])
+    >>> job = DataExtract(cdw, 'me',
+    ...                   'Interesting Query', concepts, 123, 'job2.db')
+    >>> dest_db = in_memory_db()
+    >>> _ = DataDest(dest_db, '/home/me/heron/job2.db').export(job)
+    >>> dest_db.execute('select name, redundant from variable'
+    ...                 ' order by id').fetchall()
+    [(u'n1', 0), (u'n1 x1', 1), (u'n2', 0), (u'n1 again', 1)]
     '''
     drivername = 'sqlite'
 
-    def __init__(self, dest_db, full_path):
+    # (name, table, columns) for the summary and for readers;
+    # see extract_reader
+    output_indexes = [
+        ('observation_fact_concept', 'observation_fact',
+         'concept_cd, patient_num'),
+        ('observation_fact_patient', 'observation_fact',
+         'patient_num, start_date'),
+        ('concept_dimension_code', 'concept_dimension', 'concept_cd'),
+        ('patient_dimension_num', 'patient_dimension', 'patient_num')]
+
+    def __init__(self, dest_db, full_path,
+                 concurrent=False, pipelined=False, phase=None, stats=False):
+        '''
+        :param phase: context manager factory to run each export phase
+                      in, given the phase name; see :py:class:`JobProfiler`
+        :param stats: add per-variable value statistics to the export;
+                      see :py:class:`VariableStats`
+        '''
         self.full_path = full_path
+        self.concurrent = concurrent
+        self.stats = stats
+        self._phase = phase or _no_phase
+        copy = copy_pipelined if pipelined else tc.copy_in_chunks
 
-        def init_tables(job):
+        def init_tables(job, skip=()):
             log.info('initializing tables in %s', dest_db)
             dest_star = job.copy_star_schema(bind=dest_db)
+            for name in skip:
+                dest_star.remove(dest_star.tables[name])
             log.debug('dest_star tables: %s', dest_star.tables.keys())
             self._dumb_down_schema(dest_star)
             dest_star.drop_all(dest_db)
@@ -544,24 +1272,41 @@ class DataDest(object):
             jobt.create(bind=dest_db)
             dest_db.execute(jobt.insert(),
                             pset=job.patient_set,
+                            psets=json.dumps(job.patient_sets),
                             label=job.label,
                             concepts=json.dumps(job.concepts),
+                            filters=json.dumps(job.filters),
                             name=job.filename)
         self.export_job = export_job
 
-        def export_patients(dest_star, job):
+        def mark_finished(dest_star):
+            '''Record that the extract is complete, for readers
+            (see :py:mod:`extract_reader`).
+            '''
+            jobt = dest_star.tables['job']  # see export_job
+            dest_db.execute(jobt.update().values(
+                finished=datetime.now().isoformat(' ')))
+        self.mark_finished = mark_finished
+
+        def export_patients(dest_star, job, demographics=None):
             pd = dest_star.tables['patient_dimension']
             vd = dest_star.tables['visit_dimension']
-            [(pat_q, pat_data), (enc_q, enc_data)] = job.demographics()
-            tc.copy_in_chunks(dest_db, pat_data, pd,
-                              'demographics (patient_dimension)', [])
-            tc.copy_in_chunks(dest_db, enc_data, vd,
-                              'demographics (visit_dimension)', [])
+            coh = self.cohort_table(dest_star)
+            coh.drop(bind=dest_db, checkfirst=True)
+            coh.create(bind=dest_db)
+            [(pat_q, pat_data), (enc_q, enc_data), (coh_q, coh_data)] = (
+                demographics or job.demographics())
+            copy(dest_db, pat_data, pd,
+                 'demographics (patient_dimension)', [])
+            copy(dest_db, enc_data, vd,
+                 'demographics (visit_dimension)', [])
+            copy(dest_db, coh_data, coh,
+                 'patient set membership (cohort)', [])
             return dest_db.execute(
                 'select count(*) from patient_dimension').scalar()
         self.export_patients = export_patients
 
-        def export_terms(dest_star, job):
+        def export_terms(dest_star, job, term_info=None):
             v = self.variable_table(dest_star)
             keys = job.concepts['keys']
             names = job.concepts['names']
@@ -572,38 +1317,42 @@ class DataDest(object):
                                   item_key=key,
                                   concept_path=path,
                                   name_char=name,
-                                  name=strip_counts(name))
-                             for (id, (path, key, name)) in
-                             enumerate(zip(paths, keys, names))])
-
-            [(q_cd, result_cd), (q_md, result_md)] = job.term_info()
+                                  name=strip_counts(name),
+                                  redundant=redundant)
+                             for (id, (path, key, name, redundant)) in
+                             enumerate(zip(paths, keys, names,
+                                           job.redundant))])
+
+            [(q_cd, result_cd), (q_md, result_md)] = (
+                term_info or job.term_info())
             cd = dest_star.tables['concept_dimension']
             md = dest_star.tables['modifier_dimension']
 
             values = lambda _: dict(concept_path=bindparam('concept_path'),
                                     concept_cd=bindparam('concept_cd'))
-            tc.copy_in_chunks(dest_db, result_cd, cd,
-                              'concept_dimension', [],
-                              values=values)
+            copy(dest_db, result_cd, cd,
+                 'concept_dimension', [],
+                 values=values)
             values = lambda _: dict(concept_path=bindparam('modifier_path'),
                                     concept_cd=bindparam('modifer_cd'))
-            tc.copy_in_chunks(dest_db, result_cd, md,
-                              'modifier_dimension', [])
+            copy(dest_db, result_cd, md,
+                 'modifier_dimension', [])
         self.export_terms = export_terms
 
-        def export_data(dest_star, job):
-            q, data = job.patient_data()
+        def export_data(dest_star, job, patient_data=None):
+            q, data = patient_data or job.patient_data()
             obs = dest_star.tables['observation_fact']
             dest_db.execute(obs.delete())
-            tc.copy_in_chunks(dest_db, data, obs,
-                              'patient data', [])
+            copy(dest_db, data, obs,
+                 'patient data', [])
         self.export_data = export_data
 
         def export_summary():
             dest_db.execute('''
             create view data_summary as
             select v.concept_path, v.name_char,
-              count(distinct patient_num) pat_qty, count(*) fact_qty
+              count(distinct patient_num) pat_qty,
+              count(distinct f.rowid) fact_qty
             from observation_fact f
             join concept_dimension cd
             on cd.concept_cd = f.concept_cd
@@ -614,6 +1363,41 @@ class DataDest(object):
             return dest_db.execute('select * from data_summary').fetchall()
         self.export_summary = export_summary
 
+        def export_stats(dest_star, fact_dbs=None, terms=None):
+            '''
+            :param fact_dbs: databases that see the facts; by default,
+                             just `dest_db`
+            :param terms: schema of `variable` and `concept_dimension`
+                          in `fact_dbs`, if not the main one
+            '''
+            described = collect_variable_stats(fact_dbs or [dest_db],
+                                               terms=terms)
+            vs = self.variable_stats_table(dest_star)
+            vs.drop(bind=dest_db, checkfirst=True)
+            vs.create(bind=dest_db)
+            if described:
+                dest_db.execute(vs.insert(),
+                                [stats.record(v.id, v.name_char)
+                                 for (v, stats) in described])
+            return VariableStats.format(described)
+        self.export_stats = export_stats
+
+        def fact_route(dest_star):
+            '''Where facts go and which ones, once terms and patients
+            are exported; see :py:meth:`BuilderApp.batch`.
+
+            :return: (db, table, patient_nums, concept_cds)
+            '''
+            coh = self.cohort_table(dest_star)
+            patients = set(num for (num,) in dest_db.execute(
+                select([coh.c.patient_num]).distinct()))
+            codes = set(cd for (cd,) in dest_db.execute(
+                'select distinct concept_cd from concept_dimension'))
+            obs = dest_star.tables['observation_fact']
+            dest_db.execute(obs.delete())
+            return dest_db, obs, patients, codes
+        self.fact_route = fact_route
+
     @classmethod
     def mk_db(cls, create_engine, on):
         dburl = DBURL(drivername=cls.drivername, database=on.ro().fullPath())
@@ -622,35 +1406,270 @@ class DataDest(object):
 
     def export(self, job,
                term_table_name='code'):
-        log.info('exporting: %d concepts from #%d %s',
-                 len(job.concepts), job.patient_set, job.label)
+        log.info('exporting: %d concepts from %s %s',
+                 len(job.concepts),
+                 ', '.join('#%d' % ps for ps in job.patient_sets),
+                 job.label)
+
+        phase = self._phase
+        dest_star = self.start(job)
+        if self.concurrent:
+            with phase('export_concurrently'):
+                pat_qty = self._export_concurrently(dest_star, job)
+        else:
+            with phase('export_data'):
+                self.export_data(dest_star, job)
+            with phase('export_terms'):
+                self.export_terms(dest_star, job)
+            with phase('export_patients'):
+                pat_qty = self.export_patients(dest_star, job)
+        return self.finish(dest_star, job, pat_qty)
+
+    def start(self, job):
+        with self._phase('init_tables'):
+            dest_star = self.init_tables(job)
+            self.export_job(dest_star, job)
+        return dest_star
+
+    def finish(self, dest_star, job, pat_qty):
+        phase = self._phase
+        with phase('index_tables'):
+            self.create_indexes(dest_star.bind)
+        with phase('export_summary'):
+            summary = self.format_summary(
+                (v.name_char, v.pat_qty, v.fact_qty)
+                for v in self.export_summary())
+        log.info('data summary:\n%s', summary)
 
-        dest_star = self.init_tables(job)
-        self.export_job(dest_star, job)
-        self.export_data(dest_star, job)
-        self.export_terms(dest_star, job)
-        pat_qty = self.export_patients(dest_star, job)
+        out = dict(id=job.patient_set,
+                   patient_sets=job.patient_sets,
+                   n_patient=pat_qty,
+                   filename=self.full_path,
+                   str=summary)
+        if self.stats:
+            with phase('export_stats'):
+                out['stats'] = self.export_stats(dest_star)
+            log.info('variable statistics:\n%s', out['stats'])
+        self.mark_finished(dest_star)
+        return out
 
-        summary = '\n'.join(
+    @classmethod
+    def export_batch(cls, jobs):
+        '''Export several jobs with the same filters, scanning facts once.
+
+        Terms and patients are exported for each job as usual; then one
+        fact query covers all of their concepts and patient sets, and
+        each row goes to every destination whose job has both its
+        patient (in its `cohort`) and its concept code.
+
+        Each file comes out just as if its job were exported alone,
+        even when the jobs share neither patients nor concepts:
+
+        >>> from i2b2_project_mock import in_memory_db, mock_cdw
+        >>> cdw = mock_cdw(10, 100)
+        >>> _ = cdw.execute(i2b2_star.t_qt_patient_set_collection.insert(),
+        ...                 [dict(patient_set_coll_id=100 + p,
+        ...                       result_instance_id=124, patient_num=p)
+        ...                  for p in (1, 3, 5)])
+        >>> specs = [('k1', dict(keys=[r'\\\\tk\\k1'], names=['n1']), 123),
+        ...          ('k2', dict(keys=[r'\\\\tk\\k2'], names=['n2']), 124)]
+        >>> def prepare():
+        ...     dbs = [in_memory_db() for _ in specs]
+        ...     return dbs, [
+        ...         (DataExtract(cdw, 'me', 'Interesting Query', concepts,
+        ...                      pset, name + '.db'),
+        ...          DataDest(db, '/home/me/heron/%s.db' % name))
+        ...         for (db, (name, concepts, pset)) in zip(dbs, specs)]
+        >>> def contents(db):
+        ...     return [sorted(db.execute('select * from %s' % t).fetchall())
+        ...             for t in ['observation_fact', 'patient_dimension',
+        ...                       'concept_dimension', 'variable']]
+
+        >>> alone_dbs, jobs = prepare()
+        >>> alone = [dest.export(job) for (job, dest) in jobs]
+        >>> batch_dbs, jobs = prepare()
+        >>> batched = DataDest.export_batch(jobs)
+
+        >>> [contents(a) == contents(b)
+        ...  for (a, b) in zip(alone_dbs, batch_dbs)]
+        [True, True]
+        >>> [a['str'] == b['str'] for (a, b) in zip(alone, batched)]
+        [True, True]
+        >>> [len(contents(db)[0]) > 0 for db in batch_dbs]
+        [True, True]
+        >>> [sorted(set(pat for (pat, ) in db.execute(
+        ...      'select patient_num from observation_fact')))
+        ...  for db in batch_dbs]
+        [[0, 2, 4, 6, 8], [1, 3, 5]]
+
+        :param jobs: (:py:class:`DataExtract`, :py:class:`DataDest`) pairs
+        :return: results, as from :py:meth:`export`, for each job
+        '''
+        started = []
+        for (job, dest) in jobs:
+            dest_star = dest.start(job)
+            with dest._phase('export_terms'):
+                dest.export_terms(dest_star, job)
+            with dest._phase('export_patients'):
+                pat_qty = dest.export_patients(dest_star, job)
+            started.append((dest_star, pat_qty))
+
+        routes = [dest.fact_route(dest_star)
+                  for ((_job, dest), (dest_star, _qty))
+                  in zip(jobs, started)]
+
+        def route(row):
+            return [ix for (ix, (_db, _t, patients, codes))
+                    in enumerate(routes)
+                    if row['patient_num'] in patients and
+                    row['concept_cd'] in codes]
+
+        (first, first_dest) = jobs[0]
+        merged = first.merge([job for (job, _dest) in jobs[1:]])
+        with first_dest._phase('export_data'):
+            _q, data = merged.patient_data()
+            copy_sharded([(db, obs) for (db, obs, _p, _c) in routes],
+                         data, 'patient data for %d jobs' % len(jobs),
+                         route=route)
+
+        return [dest.finish(dest_star, job, pat_qty)
+                for ((job, dest), (dest_star, pat_qty))
+                in zip(jobs, started)]
+
+    @classmethod
+    def create_indexes(cls, db):
+        '''Create :py:attr:`output_indexes` on the tables `db` has.
+        '''
+        present = set(name for (name,) in db.execute(
+            "select name from sqlite_master where type = 'table'"))
+        for (name, table, columns) in cls.output_indexes:
+            if table in present:
+                db.execute('create index if not exists %s on %s (%s)' % (
+                    name, table, columns))
+
+    @classmethod
+    def format_summary(cls, counts):
+        '''
+        :param counts: (name_char, pat_qty, fact_qty) for each variable
+        '''
+        return '\n'.join(
             ['%-40s %10s %10s' % ('Variable', 'N. Patient', 'N. Obs.')] +
-            ['%-40s %10d %10d' %
-             (v.name_char[:40], v.pat_qty, v.fact_qty)
-             for v in self.export_summary()])
-        log.info('data summary:\n%s', summary)
+            ['%-40s %10d %10d' % (name_char[:40], pat_qty, fact_qty)
+             for (name_char, pat_qty, fact_qty) in counts])
+
+    def _export_concurrently(self, dest_star, job,
+                             chunk_size=1000, depth=4):
+        '''Run the CDW queries in parallel; write results as they arrive.
 
-        return dict(id=job.patient_set,
-                    n_patient=pat_qty,
-                    filename=self.full_path,
-                    str=summary)
+        Each phase has a reader thread with its own CDW connection,
+        which fetches each of its results ahead into a bounded queue
+        (see :py:class:`Prefetch`); writes to the destination stay on
+        this thread, one phase at a time, in the order they're ready.
+
+        :return: patient count, as from `export_patients`
+        '''
+        phases = [('patient data', job.patient_data, self.export_data),
+                  ('term info', job.term_info, self.export_terms),
+                  ('demographics', job.demographics, self.export_patients)]
+        ready = Queue()
+        prefetched = []
+
+        def read(what, query):
+            conn, announced = None, False
+            try:
+                conn = job.connect()
+                results = query(db=conn)
+                pairs = results if isinstance(results, list) else [results]
+                fetched = [(q, Prefetch(what, chunk_size, depth))
+                           for (q, _result) in pairs]
+                prefetched.extend(rows for (_q, rows) in fetched)
+                ready.put((what, fetched if isinstance(results, list)
+                           else fetched[0], None))
+                announced = True
+                error = None
+                for ((_q, result), (_q, rows)) in zip(pairs, fetched):
+                    if error is None:
+                        error = rows.fill(result)
+                    else:
+                        rows.fail(error)
+            except Exception as ex:
+                log.error('error reading %s:', what, exc_info=ex)
+                if not announced:
+                    ready.put((what, None, ex))
+            finally:
+                if conn is not None:
+                    conn.close()
+
+        readers = [Thread(target=read, args=(what, query),
+                          name='read %s' % what)
+                   for (what, query, _write) in phases]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        write_to = dict((what, write) for (what, _q, write) in phases)
+        out = {}
+        pending = len(phases)
+        try:
+            while pending:
+                what, results, ex = ready.get()
+                pending -= 1
+                if ex:
+                    raise ex
+                log.info('%s ready; writing', what)
+                out[what] = write_to[what](dest_star, job, results)
+        finally:
+            # After an error, wait for the other queries, then stop
+            # their readers, which release their connections.
+            while pending:
+                ready.get()
+                pending -= 1
+            for rows in prefetched:
+                rows.stop()
+            for reader in readers:
+                reader.join()
+        return out['demographics']
 
     @classmethod
     def job_table(cls, meta,
                   name='job'):
         return Table(name, meta,
                      Column('pset', types.Integer),
+                     Column('psets', types.String),
                      Column('label', types.String),
                      Column('concepts', types.String),
-                     Column('name', types.String))
+                     Column('filters', types.String),
+                     Column('name', types.String),
+                     Column('finished', types.String))
+
+    @classmethod
+    def variable_stats_table(cls, meta,
+                             name='variable_stats'):
+        columns = (
+            [Column('variable_id', types.Integer),
+             Column('name_char', types.String),
+             Column('fact_qty', types.Integer),
+             Column('num_qty', types.Integer),
+             Column('num_min', types.Float),
+             Column('num_max', types.Float),
+             Column('num_mean', types.Float)] +
+            [Column('num_p%02d' % int(q * 100), types.Float)
+             for q in VariableStats.quantiles] +
+            [Column('text_qty', types.Integer),
+             Column('top_text', types.String),
+             Column('first_date', types.String),
+             Column('last_date', types.String)])
+        return Table(name, meta, *columns, extend_existing=True)
+
+    @classmethod
+    def cohort_table(cls, meta,
+                     name='cohort'):
+        '''Patient set membership, for jobs that span several sets.
+        '''
+        return Table(name, meta,
+                     Column('pset', types.Integer),
+                     Column('patient_num', types.Integer),
+                     extend_existing=True)
 
     @classmethod
     def variable_table(cls, meta,
@@ -705,6 +1724,932 @@ class DataDest(object):
         return db.execute('select * from variable').fetchall()
 
 
+class Prefetch(object):
+    '''Rows of a query result, fetched ahead by another thread.
+
+    The reader thread runs :py:meth:`fill`, which puts batches of rows
+    in a queue of at most `depth` of them; the consumer takes them by
+    :py:meth:`batch`, or by `fetchmany` as from the result itself.
+
+    >>> class Rows(object):
+    ...     def __init__(self, rows):
+    ...         self.rows = rows
+    ...     def fetchmany(self, n):
+    ...         batch, self.rows = self.rows[:n], self.rows[n:]
+    ...         return batch
+    >>> source = Rows(range(100))
+    >>> rows = Prefetch('numbers', chunk_size=10, depth=2)
+    >>> reader = Thread(target=rows.fill, args=(source,))
+    >>> reader.start()
+
+    The reader gets ahead of the consumer, but only by `depth` batches
+    (plus the one it's waiting to put):
+
+    >>> reader.join(0.5)
+    >>> len(source.rows)
+    70
+    >>> len(rows.fetchmany(25)), sum(len(b) for b in iter(rows.batch, []))
+    (25, 75)
+
+    After :py:meth:`stop`, the reader gives up rather than waiting on a
+    full queue:
+
+    >>> source = Rows(range(100))
+    >>> rows = Prefetch('numbers', chunk_size=10, depth=2)
+    >>> reader = Thread(target=rows.fill, args=(source,))
+    >>> reader.start()
+    >>> rows.stop()
+    >>> reader.join(); len(source.rows) > 50
+    True
+    '''
+    def __init__(self, what,
+                 chunk_size=1000, depth=4):
+        self.what = what
+        self.chunk_size = chunk_size
+        self.read_blocked = 0.0
+        self.write_blocked = 0.0
+        self._batches = Queue(maxsize=depth)
+        self._stopped = []
+        self._ended = False
+        self._rows = []
+
+    def fill(self, result):
+        '''Fetch all of `result`, unless stopped; run on the reader thread.
+
+        :return: the error that stopped it, if any
+        '''
+        try:
+            while not self._stopped:
+                rows = result.fetchmany(self.chunk_size)
+                self._put(rows)
+                if not rows:
+                    break
+        except Exception as ex:
+            log.error('error reading %s:', self.what, exc_info=ex)
+            self.fail(ex)
+            return ex
+
+    def fail(self, ex):
+        '''Pass `ex` to the consumer in place of further rows.'''
+        self._put(ex)
+
+    def _put(self, item):
+        t0 = time.time()
+        while not self._stopped:
+            try:
+                self._batches.put(item, timeout=0.1)
+                break
+            except Full:
+                pass
+        self.read_blocked += time.time() - t0
+
+    def stop(self):
+        '''Stop the reader, e.g. after a failed write.'''
+        self._stopped.append(True)
+
+    def batch(self):
+        '''Next batch of rows; [] at the end.
+
+        :raises Exception: the error that stopped the reader
+        '''
+        if self._rows:
+            rows, self._rows = self._rows, []
+            return rows
+        return self._next()
+
+    def _next(self):
+        if self._ended:
+            return []
+        t0 = time.time()
+        rows = self._batches.get()
+        self.write_blocked += time.time() - t0
+        if isinstance(rows, Exception):
+            self._ended = True
+            raise rows
+        if not rows:
+            self._ended = True
+        return rows
+
+    def fetchmany(self, size):
+        while len(self._rows) < size and not self._ended:
+            self._rows.extend(self._next())
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+
+def copy_pipelined(dest_db, result, table, what, exclude,
+                   chunk_size=1000, depth=4, values=None):
+    '''Copy rows from `result` to `table`, fetching and writing in parallel.
+
+    A reader thread fetches batches of `chunk_size` rows into a queue
+    of at most `depth` batches, which the calling thread writes to
+    `dest_db`. Time each side spends waiting on the other shows
+    whether the source or the destination is the bottleneck.
+
+    >>> from sqlalchemy import create_engine
+    >>> dest_db = create_engine('sqlite://')
+    >>> m = MetaData()
+    >>> t = Table('t', m, Column('x', types.Integer),
+    ...           Column('y', types.String))
+    >>> m.create_all(dest_db)
+
+    >>> class Rows(object):
+    ...     def __init__(self, rows):
+    ...         self.rows = rows
+    ...     def fetchmany(self, n):
+    ...         batch, self.rows = self.rows[:n], self.rows[n:]
+    ...         return batch
+    >>> rows = Rows([dict(x=x, y=str(x), z=0) for x in range(25)])
+
+    >>> stats = copy_pipelined(dest_db, rows, t, 'test rows', ['z'],
+    ...                        chunk_size=10, depth=2)
+    >>> stats['rows'], stats['batches']
+    (25, 3)
+    >>> sorted(stats.keys())
+    ['batches', 'read_blocked', 'rows', 'write_blocked']
+    >>> dest_db.execute('select sum(x) from t').scalar()
+    300
+
+    If a write fails, the reader stops too, rather than waiting on a
+    full queue with the source cursor open:
+
+    >>> missing = Table('missing', m, Column('x', types.Integer))
+    >>> rows = Rows([dict(x=x) for x in range(1000)])
+    >>> copy_pipelined(dest_db, rows, missing, 'bad rows', [],
+    ...                chunk_size=10, depth=1)
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+      ...
+    OperationalError: ...no such table: missing...
+    >>> len(rows.rows) > 900
+    True
+
+    :param exclude: names of columns not to copy
+    :param values: function from `table` to values for the insert
+    :return: dict of row and batch counts, plus seconds the reader spent
+             blocked on a full queue and the writer on an empty one
+    '''
+    fetched = Prefetch(what, chunk_size, depth)
+    reader = Thread(target=fetched.fill, args=(result,),
+                    name='read %s' % what)
+    reader.daemon = True
+    reader.start()
+
+    ins = table.insert()
+    if values is not None:
+        ins = ins.values(values(table))
+
+    qty, n_batch = 0, 0
+    finished = False
+    try:
+        while True:
+            rows = fetched.batch()
+            if not rows:
+                break
+            dest_db.execute(ins, [dict((k, v)
+                                       for (k, v) in dict(row).items()
+                                       if k not in exclude)
+                                  for row in rows])
+            qty += len(rows)
+            n_batch += 1
+            log.debug('%s: %d rows', what, qty)
+        finished = True
+    finally:
+        if not finished:
+            # Stop the reader and give up the source cursor.
+            fetched.stop()
+        reader.join()
+        if not finished and hasattr(result, 'close'):
+            result.close()
+
+    log.info('%s: %d rows in %d batches; '
+             'reader blocked %.1fs, writer blocked %.1fs',
+             what, qty, n_batch, fetched.read_blocked, fetched.write_blocked)
+    return dict(rows=qty, batches=n_batch,
+                read_blocked=fetched.read_blocked,
+                write_blocked=fetched.write_blocked)
+
+
+class ShardedDest(DataDest):
+    '''Data extract destination split by patient across several files.
+
+    Patients go to shard ``patient_num % len(shards)``, along with their
+    visits, cohort membership and facts; shards are written in parallel.
+    The main (manifest) database holds the `job`, `variable`,
+    `concept_dimension` and `modifier_dimension` tables, plus a `shard`
+    table listing the shard files; see :py:meth:`attach_shards`.
+    Each shard gets a copy of those tables too, so that it can be read
+    on its own (see :py:mod:`extract_reader`).
+
+    >>> import os, tempfile
+    >>> from sqlalchemy import create_engine
+    >>> from i2b2_project_mock import mock_cdw
+    >>> work = tempfile.mkdtemp()
+    >>> paths = [os.path.join(work, 'job1%s.db' % part)
+    ...          for part in ['', '.shard0', '.shard1']]
+    >>> dbs = [create_engine('sqlite:///' + path) for path in paths]
+    >>> dest = ShardedDest(dbs[0], paths[0], zip(dbs[1:], paths[1:]))
+
+    >>> concepts = dict(keys=[r'\\tk\k1', r'\\tk\k2'],
+    ...                 names=['n1', 'n2'])
+    >>> job = DataExtract(mock_cdw(10, 100), 'me',
+    ...                   'Interesting Query', concepts, 123, 'job1.db')
+    >>> out = dest.export(job)
+    >>> print out['str']
+    ... # doctest: +NORMALIZE_WHITESPACE
+    Variable                                 N. Patient    N. Obs.
+    n1                                                5        116
+    n2                                                5        116
+
+    >>> conn = dbs[0].connect()
+    >>> ShardedDest.attach_shards(conn)
+    2
+    >>> conn.execute('select count(*) from patient_dimension').scalar()
+    5
+
+    >>> [(db.execute('select count(*) from variable').scalar(),
+    ...   db.execute('select finished from job').scalar() is not None)
+    ...  for db in dbs]
+    [(2, True), (2, True), (2, True)]
+    '''
+    shard_tables = ['patient_dimension', 'visit_dimension',
+                    'observation_fact', 'cohort']
+
+    # SQLite's default limit on attached databases; see attach_shards
+    max_shards = 10
+
+    def __init__(self, dest_db, full_path, shards,
+                 **opts):
+        '''
+        :param shards: (db, full_path) for each shard, at most
+                       :py:attr:`max_shards` of them
+        :param opts: as for :py:class:`DataDest`; they apply to the
+                     manifest database
+        '''
+        if len(shards) > self.max_shards:
+            raise ValueError('at most %d shards can be attached; got %d' % (
+                self.max_shards, len(shards)))
+        DataDest.__init__(self, dest_db, full_path, **opts)
+        self._manifest_db = dest_db
+        self._shards = [(DataDest(db, path), db, path)
+                        for (db, path) in shards]
+
+    def export(self, job,
+               term_table_name='code'):
+        log.info('exporting: %d concepts from %s %s to %d shards',
+                 len(job.concepts),
+                 ', '.join('#%d' % ps for ps in job.patient_sets),
+                 job.label, len(self._shards))
+
+        manifest_db = self._manifest_db
+        dest_star = self.init_tables(
+            job, skip=['patient_dimension', 'visit_dimension',
+                       'observation_fact'])
+        shard_t = self.shard_table(dest_star)
+        shard_t.drop(bind=manifest_db, checkfirst=True)
+        shard_t.create(bind=manifest_db)
+        manifest_db.execute(shard_t.insert(),
+                            [dict(ix=ix, filename=path)
+                             for (ix, (_d, _db, path))
+                             in enumerate(self._shards)])
+
+        self.export_job(dest_star, job)
+        with self._phase('export_terms'):
+            self.export_terms(dest_star, job)
+
+        shard_stars = []
+        for (dest, db, _path) in self._shards:
+            star = dest.init_tables(job)
+            cohort = self.cohort_table(star)
+            cohort.drop(bind=db, checkfirst=True)
+            cohort.create(bind=db)
+            dest.export_job(star, job)
+            self._copy_terms(db, star)
+            shard_stars.append(star)
+
+        def tables(name):
+            return [(db, star.tables[name])
+                    for ((_d, db, _p), star)
+                    in zip(self._shards, shard_stars)]
+
+        with self._phase('export_patients'):
+            [(_q, pat_data), (_q, enc_data), (_q, coh_data)] = (
+                job.demographics())
+            copy_sharded(tables('patient_dimension'), pat_data,
+                         'demographics (patient_dimension)')
+            copy_sharded(tables('visit_dimension'), enc_data,
+                         'demographics (visit_dimension)')
+            copy_sharded(tables('cohort'), coh_data,
+                         'patient set membership (cohort)')
+        with self._phase('export_data'):
+            _q, data = job.patient_data()
+            copy_sharded(tables('observation_fact'), data, 'patient data')
+        with self._phase('index_tables'):
+            for db in [manifest_db] + [db for (_d, db, _p) in self._shards]:
+                self.create_indexes(db)
+
+        pat_qty = 0
+        counts = {}
+        for (_d, db, _p) in self._shards:
+            pat_qty += db.execute(
+                'select count(*) from patient_dimension').scalar()
+            for (path, name_char, pat, facts) in self._shard_summary(db):
+                n = counts.get((path, name_char), (0, 0))
+                counts[(path, name_char)] = (n[0] + pat, n[1] + facts)
+        summary = self.format_summary(
+            (name_char, pat, facts)
+            for ((_path, name_char), (pat, facts)) in sorted(counts.items()))
+        log.info('data summary:\n%s', summary)
+
+        out = dict(id=job.patient_set,
+                   patient_sets=job.patient_sets,
+                   n_patient=pat_qty,
+                   filename=self.full_path,
+                   shards=[path for (_d, _db, path) in self._shards],
+                   str=summary)
+        if self.stats:
+            conns = [self._with_manifest(db) for (_d, db, _p) in self._shards]
+            try:
+                with self._phase('export_stats'):
+                    out['stats'] = self.export_stats(dest_star, conns,
+                                                     terms='manifest')
+            finally:
+                for conn in conns:
+                    conn.close()
+            log.info('variable statistics:\n%s', out['stats'])
+        for ((dest, _db, _p), star) in zip(self._shards, shard_stars):
+            dest.mark_finished(star)
+        self.mark_finished(dest_star)
+        return out
+
+    def _with_manifest(self, shard_db):
+        '''Connect to a shard, with the manifest database attached.
+        '''
+        conn = shard_db.connect()
+        conn.execute("attach database ? as manifest", self.full_path)
+        return conn
+
+    def _copy_terms(self, shard_db, shard_star):
+        '''Copy the manifest's terms into a shard.
+        '''
+        self.variable_table(shard_star).create(bind=shard_db)
+        conn = self._with_manifest(shard_db)
+        try:
+            for name in ['variable', 'concept_dimension',
+                         'modifier_dimension']:
+                conn.execute('insert into %s select * from manifest.%s' % (
+                    name, name))
+        finally:
+            conn.close()
+
+    def _shard_summary(self, shard_db):
+        '''Per-variable counts for one shard, using the manifest's terms.
+
+        Patients are disjoint across shards, so counts add up.
+        '''
+        conn = self._with_manifest(shard_db)
+        try:
+            return conn.execute('''
+            select v.concept_path, v.name_char,
+              count(distinct patient_num) pat_qty,
+              count(distinct f.rowid) fact_qty
+            from observation_fact f
+            join manifest.concept_dimension cd
+            on cd.concept_cd = f.concept_cd
+            join manifest.variable v
+            on cd.concept_path like (v.concept_path || '%')
+            group by v.concept_path, v.name_char
+            ''').fetchall()
+        finally:
+            conn.close()
+
+    @classmethod
+    def shard_table(cls, meta,
+                    name='shard'):
+        return Table(name, meta,
+                     Column('ix', types.Integer),
+                     Column('filename', types.String),
+                     extend_existing=True)
+
+    @classmethod
+    def attach_shards(cls, conn):
+        '''Attach shards to a connection to the manifest database and
+        make temporary views of the union of each sharded table.
+
+        SQLite limits attached databases to :py:attr:`max_shards`
+        by default.
+
+        :return: number of shards attached
+        '''
+        shards = conn.execute(
+            'select ix, filename from shard order by ix').fetchall()
+        for (ix, filename) in shards:
+            conn.execute('attach database ? as shard%d' % ix, filename)
+        for name in cls.shard_tables:
+            conn.execute('create temp view %s as %s' % (
+                name, ' union all '.join(
+                    'select * from shard%d.%s' % (ix, name)
+                    for (ix, _f) in shards)))
+        return len(shards)
+
+
+def copy_sharded(dests, result, what,
+                 chunk_size=1000, depth=4, route=None):
+    '''Copy rows from `result`, routing each by `patient_num`.
+
+    Each destination has a writer thread fed by a queue of at most
+    `depth` batches, so shards are written in parallel while memory
+    stays bounded.
+
+    :param dests: (db, table) for each shard
+    :param route: function from a row to the indexes of `dests` it
+                  goes to (any number of them); by default,
+                  ``patient_num % len(dests)``
+    :return: number of rows copied to each shard
+    '''
+    route = route or (lambda row: [row['patient_num'] % len(dests)])
+    done = object()
+    queues = [Queue(maxsize=depth) for _ in dests]
+    qty = [0] * len(dests)
+    errors = []
+
+    def write(ix):
+        db, table = dests[ix]
+        ins = table.insert()
+        while True:
+            rows = queues[ix].get()
+            if rows is done:
+                break
+            if errors:
+                continue  # keep draining so the reader doesn't block
+            try:
+                db.execute(ins, rows)
+                qty[ix] += len(rows)
+            except Exception as ex:
+                log.error('error writing %s to shard %d:', what, ix,
+                          exc_info=ex)
+                errors.append(ex)
+
+    writers = [Thread(target=write, args=(ix,),
+                      name='write %s shard %d' % (what, ix))
+               for ix in range(len(dests))]
+    for writer in writers:
+        writer.daemon = True
+        writer.start()
+
+    try:
+        while not errors:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            batches = [[] for _ in dests]
+            for row in rows:
+                rec = dict(row)
+                for ix in route(row):
+                    batches[ix].append(rec)
+            for (q, batch) in zip(queues, batches):
+                if batch:
+                    q.put(batch)
+    finally:
+        for q in queues:
+            q.put(done)
+        for writer in writers:
+            writer.join()
+    if errors:
+        raise errors[0]
+
+    log.info('%s: %s rows to %d shards', what, qty, len(dests))
+    return qty
+
+
+class QuantileSketch(object):
+    '''Approximate quantiles of a stream of numbers, in bounded memory.
+
+    When a level holds more than `k` values, every other one of them
+    (sorted) moves up a level, where each counts twice as much. Merging
+    sketches just combines their levels, so parts of a stream (e.g.
+    shards) can be summarized separately.
+
+    >>> sketch = QuantileSketch(k=64)
+    >>> for start in range(0, 10000, 1000):
+    ...     sketch.update(range(start, start + 1000))
+    >>> [abs(x - exact) < 200 for (x, exact)
+    ...  in zip(sketch.quantiles([0.25, 0.5, 0.75]), [2500, 5000, 7500])]
+    [True, True, True]
+    >>> sum(len(level) for level in sketch.levels) < 10 * 64
+    True
+    '''
+    def __init__(self, k=256):
+        self.k = k
+        self.levels = [[]]
+        self._odd = False
+
+    def update(self, values):
+        self.levels[0].extend(values)
+        self._compact()
+
+    def merge(self, other):
+        for (ix, level) in enumerate(other.levels):
+            if ix == len(self.levels):
+                self.levels.append([])
+            self.levels[ix].extend(level)
+        self._compact()
+
+    def _compact(self):
+        ix = 0
+        while ix < len(self.levels):
+            level = self.levels[ix]
+            if len(level) > self.k:
+                level.sort()
+                if len(level) % 2:
+                    self.levels[ix] = [level.pop()]
+                else:
+                    self.levels[ix] = []
+                # alternate which half survives, to avoid bias
+                self._odd = not self._odd
+                if ix + 1 == len(self.levels):
+                    self.levels.append([])
+                self.levels[ix + 1].extend(level[int(self._odd)::2])
+            ix += 1
+
+    def quantiles(self, qs):
+        weighted = sorted((value, 2 ** ix)
+                          for (ix, level) in enumerate(self.levels)
+                          for value in level)
+        total = sum(weight for (_v, weight) in weighted)
+        out = []
+        for q in qs:
+            seen = 0
+            for (value, weight) in weighted:
+                seen += weight
+                if seen >= q * total:
+                    break
+            out.append(value if weighted else None)
+        return out
+
+
+class VariableStats(object):
+    '''Mergeable description of the facts about one variable.
+
+    Batches of (nval_num, tval_char, start_date) rows update numeric
+    count/min/max/sum and a :py:class:`QuantileSketch`, counts of text
+    values (the rarest are dropped when there are very many distinct
+    ones, so top-k counts are approximate), and the date span.
+
+    >>> stats = VariableStats()
+    >>> stats.update([(1.0, None, '2001-01-01'), (3.0, None, '2002-06-01'),
+    ...               (None, 'pos', '2000-05-05'), (None, 'neg', None),
+    ...               (None, 'pos', '2003-01-01')])
+    >>> other = VariableStats()
+    >>> other.update([(2.0, None, '1999-12-31')])
+    >>> stats.merge(other)
+    >>> rec = stats.record(1, 'lab')
+    >>> rec['fact_qty'], rec['num_qty'], rec['num_min'], rec['num_max']
+    (6, 3, 1.0, 3.0)
+    >>> rec['num_mean'], rec['num_p50']
+    (2.0, 2.0)
+    >>> rec['top_text'], rec['first_date'], rec['last_date']
+    ('[["pos", 2], ["neg", 1]]', '1999-12-31', '2003-01-01')
+    '''
+    quantiles = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+    def __init__(self,
+                 top_k=5, max_distinct=10000):
+        self.top_k = top_k
+        self.max_distinct = max_distinct
+        self.fact_qty = 0
+        self.num_qty = 0
+        self.num_min = self.num_max = None
+        self.num_sum = 0.0
+        self.sketch = QuantileSketch()
+        self.text = Counter()
+        self.first_date = self.last_date = None
+
+    def update(self, rows):
+        self.fact_qty += len(rows)
+        nums = [float(n) for (n, _t, _d) in rows if n is not None]
+        if nums:
+            self._add_numbers(len(nums), min(nums), max(nums), sum(nums))
+            self.sketch.update(nums)
+        self.text.update(t for (n, t, _d) in rows
+                         if n is None and t is not None)
+        if len(self.text) > self.max_distinct:
+            self.text = Counter(dict(
+                self.text.most_common(self.max_distinct // 10)))
+        dates = [str(d)[:10] for (_n, _t, d) in rows if d is not None]
+        if dates:
+            self._add_dates(min(dates), max(dates))
+
+    def _add_numbers(self, qty, lo, hi, total):
+        self.num_qty += qty
+        self.num_min = lo if self.num_min is None else min(self.num_min, lo)
+        self.num_max = hi if self.num_max is None else max(self.num_max, hi)
+        self.num_sum += total
+
+    def _add_dates(self, first, last):
+        self.first_date = min(first, self.first_date or first)
+        self.last_date = max(last, self.last_date or last)
+
+    def merge(self, other):
+        self.fact_qty += other.fact_qty
+        if other.num_qty:
+            self._add_numbers(other.num_qty, other.num_min, other.num_max,
+                              other.num_sum)
+            self.sketch.merge(other.sketch)
+        self.text.update(other.text)
+        if other.first_date:
+            self._add_dates(other.first_date, other.last_date)
+
+    def record(self, variable_id, name_char):
+        '''Row for :py:meth:`DataDest.variable_stats_table`.'''
+        rec = dict(variable_id=variable_id,
+                   name_char=name_char,
+                   fact_qty=self.fact_qty,
+                   num_qty=self.num_qty,
+                   num_min=self.num_min,
+                   num_max=self.num_max,
+                   num_mean=(self.num_sum / self.num_qty
+                             if self.num_qty else None),
+                   text_qty=sum(self.text.values()),
+                   top_text=json.dumps(self.text.most_common(self.top_k)),
+                   first_date=self.first_date,
+                   last_date=self.last_date)
+        values = (self.sketch.quantiles(self.quantiles) if self.num_qty
+                  else [None] * len(self.quantiles))
+        for (q, value) in zip(self.quantiles, values):
+            rec['num_p%02d' % int(q * 100)] = value
+        return rec
+
+    @classmethod
+    def format(cls, described):
+        '''Summarize statistics for the completion email.
+
+        >>> stats = VariableStats()
+        >>> stats.update([(1.0, None, '2001-01-01'),
+        ...               (None, 'pos', '2003-01-01')])
+        >>> class V(object):
+        ...     id, name_char = 1, 'lab'
+        >>> print VariableStats.format([(V, stats)])
+        lab
+          numeric: 1, 1 .. 1 (median 1, mean 1)
+          text: 1; top: pos (1)
+          dates: 2001-01-01 .. 2003-01-01
+        '''
+        lines = []
+        for (v, stats) in described:
+            rec = stats.record(v.id, v.name_char)
+            lines.append(v.name_char)
+            if rec['num_qty']:
+                lines.append('  numeric: %d, %g .. %g (median %g, mean %g)' %
+                             (rec['num_qty'], rec['num_min'], rec['num_max'],
+                              rec['num_p50'], rec['num_mean']))
+            if rec['text_qty']:
+                lines.append('  text: %d; top: %s' % (
+                    rec['text_qty'], ', '.join(
+                        '%s (%d)' % (text, qty) for (text, qty)
+                        in stats.text.most_common(stats.top_k))))
+            if rec['first_date']:
+                lines.append('  dates: %s .. %s' % (rec['first_date'],
+                                                    rec['last_date']))
+        return '\n'.join(lines)
+
+
+def collect_variable_stats(dbs,
+                           terms=None, batch_size=10000):
+    '''Describe the facts for each requested variable.
+
+    Facts are read in batches, each variable's codes at a time, so
+    memory stays bounded and no fact is counted twice for a variable.
+
+    :param dbs: databases (or connections) that each see some of the
+                facts, plus the `variable` and `concept_dimension` tables
+    :param terms: schema of `variable` and `concept_dimension`,
+                  if not the main one
+    :return: [(variable, :py:class:`VariableStats`)]
+    '''
+    prefix = terms + '.' if terms else ''
+    variables = dbs[0].execute(
+        'select id, concept_path, name_char from %svariable order by id'
+        % prefix).fetchall()
+    described = []
+    for v in variables:
+        stats = VariableStats()
+        for db in dbs:
+            part = VariableStats()
+            result = db.execute('''
+            select f.nval_num, f.tval_char, f.start_date
+            from observation_fact f
+            where f.concept_cd in (
+              select cd.concept_cd from %sconcept_dimension cd
+              where cd.concept_path like (:path || '%%'))
+            ''' % prefix, path=v.concept_path)
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                part.update(rows)
+            stats.merge(part)
+        described.append((v, stats))
+    return described
+
+
+def table_counts(db):
+    '''Count rows in each table of a SQLite database.
+
+    >>> from sqlalchemy import create_engine
+    >>> db = create_engine('sqlite://')
+    >>> _ = db.execute('create table t (x int)')
+    >>> _ = db.execute('insert into t values (1)')
+    >>> table_counts(db)
+    [(u't', 1)]
+    '''
+    names = [name for (name, ) in db.execute(
+        "select name from sqlite_master where type = 'table' order by name")]
+    return [(name, db.execute('select count(*) from "%s"' % name).scalar())
+            for name in names]
+
+
+class _DigestWriter(object):
+    '''Pass writes along to `out`, keeping a checksum and byte count.
+    '''
+    def __init__(self, out):
+        self._out = out
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        self._out.write(data)
+
+    def flush(self):
+        self._out.flush()
+
+
+pack_suffixes = dict(gzip='.gz', zstd='.zst')
+
+
+def package_extract(db, src, packed_file, manifest,
+                    method='gzip', block_size=1 << 20, remove=None):
+    '''Compress a finished extract, with a checksum and manifest.
+
+    >>> import os, tempfile
+    >>> from sqlalchemy import create_engine
+    >>> work = lafile.Editable(tempfile.mkdtemp(), os, open)
+    >>> src = work / 'job1.db'
+    >>> db = create_engine('sqlite:///' + src.ro().fullPath())
+    >>> _ = db.execute('create table t (x int)')
+    >>> _ = db.execute('insert into t values (1)')
+    >>> packed_file = lambda suffix: work / ('job1.db' + suffix)
+    >>> info = package_extract(db, src.ro(), packed_file,
+    ...                        work / 'job1.db.manifest.json')
+    >>> info['method'], info['tables']
+    ('gzip', {u't': 1})
+    >>> os.path.basename(info['packed_filename'])
+    'job1.db.gz'
+
+    The manifest describes the uncompressed file:
+
+    >>> plain = gzip.open(info['packed_filename']).read()
+    >>> len(plain) == info['size']
+    True
+    >>> hashlib.sha256(plain).hexdigest() == info['sha256']
+    True
+    >>> json.load((work / 'job1.db.manifest.json').ro().inChannel()) == info
+    True
+
+    Given a way to `remove` it, the uncompressed file goes, once the
+    compressed copy is checked:
+
+    >>> info = package_extract(db, src.ro(), packed_file,
+    ...                        work / 'job1.db.manifest.json',
+    ...                        remove=os.remove)
+    >>> info['removed'], src.ro().exists()
+    (True, False)
+    >>> os.path.exists(info['packed_filename'])
+    True
+
+    >>> package_extract(db, src.ro(), packed_file,
+    ...                 work / 'job1.db.manifest.json', method='bz2')
+    Traceback (most recent call last):
+      ...
+    ValueError: unknown compression method: bz2
+
+    :param db: the extract database, for table row counts
+    :param src: lafile.Readable for the extract file
+    :param packed_file: function from a suffix (see
+                        :py:data:`pack_suffixes`) to lafile.Editable
+                        for the compressed copy
+    :param manifest: lafile.Editable for the JSON manifest
+    :param method: ``zstd`` (multithreaded; falls back to ``gzip`` if
+                   the `zstandard` package is not installed) or ``gzip``
+    :param remove: function to remove the uncompressed file, given its
+                   full path, once the compressed copy is checked;
+                   by default, it is kept
+    :return: the manifest, as a dict
+    '''
+    if method not in pack_suffixes:
+        raise ValueError('unknown compression method: %s' % method)
+    if method == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            log.warning('zstandard not available; using gzip')
+            method = 'gzip'
+    packed = packed_file(pack_suffixes[method])
+
+    tables = table_counts(db)
+    plain = hashlib.sha256()
+    size = 0
+    t0 = time.time()
+    src_in, out = src.inChannel(), packed.outChannel()
+    try:
+        packed_out = _DigestWriter(out)
+        if method == 'zstd':
+            compressor = zstandard.ZstdCompressor(threads=-1)
+            stream = compressor.stream_writer(packed_out)
+        else:
+            stream = gzip.GzipFile(fileobj=packed_out, mode='wb')
+        while True:
+            block = src_in.read(block_size)
+            if not block:
+                break
+            plain.update(block)
+            size += len(block)
+            stream.write(block)
+        if method == 'zstd':
+            stream.flush(zstandard.FLUSH_FRAME)
+        else:
+            stream.close()
+    finally:
+        src_in.close()
+        out.close()
+    log.info('packed %s: %d -> %d bytes (%s) in %.1fs',
+             src.fullPath(), size, packed_out.size, method,
+             time.time() - t0)
+
+    info = dict(filename=src.fullPath(),
+                packed_filename=packed.ro().fullPath(),
+                method=method,
+                size=size,
+                packed_size=packed_out.size,
+                sha256=plain.hexdigest(),
+                packed_sha256=packed_out.digest.hexdigest(),
+                tables=dict(tables),
+                removed=False)
+    if remove:
+        unpacked = _unpacked_digest(packed.ro(), method, block_size)
+        if unpacked == (info['sha256'], size):
+            info['removed'] = True
+        else:
+            log.error('packed copy of %s does not match; keeping it',
+                      src.fullPath())
+    manifest_out = manifest.outChannel()
+    try:
+        json.dump(info, manifest_out, indent=2, sort_keys=True)
+    finally:
+        manifest_out.close()
+    if info['removed']:
+        db.dispose()
+        remove(src.fullPath())
+        log.info('removed %s', src.fullPath())
+    return info
+
+
+def _unpacked_digest(packed, method, block_size):
+    '''Checksum and size of the contents of a compressed file.
+    '''
+    packed_in = packed.inChannel()
+    try:
+        if method == 'zstd':
+            import zstandard
+            stream = zstandard.ZstdDecompressor().stream_reader(packed_in)
+        else:
+            stream = gzip.GzipFile(fileobj=packed_in, mode='rb')
+        digest, size = hashlib.sha256(), 0
+        while True:
+            block = stream.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+            size += len(block)
+    finally:
+        packed_in.close()
+    return digest.hexdigest(), size
+
+
+def human_size(qty):
+    '''
+    >>> human_size(123), human_size(45678), human_size(3 * 1024 ** 3)
+    ('123 B', '44.6 KB', '3.0 GB')
+    '''
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if qty < 1024 or unit == 'GB':
+            break
+        qty /= 1024.0
+    return ('%d %s' if unit == 'B' else '%.1f %s') % (qty, unit)
+
+
 def strip_counts(txt):
     '''
     >>> strip_counts('broken toe [200 facts]')
@@ -719,11 +2664,39 @@ class BuilderApp(object):
 
     heron_work_dir = 'heron'
 
-    def __init__(self, access):
+    def __init__(self, access,
+                 dest_opts={}, sql_cache=None, compress=None, shards=1,
+                 remove=None):
         self._access = access
+        self._dest_opts = dest_opts
+        self._sql_cache = sql_cache
+        self._compress = compress
+        self._shards = shards
+        self._remove = remove
 
     @classmethod
-    def make(cls, cdw_section, db_access, home_dirs, ext='.db'):
+    def make(cls, cdw_section, db_access, home_dirs, ext='.db',
+             sql_cache=None, compress=None, shards=1, remove=None,
+             **dest_opts):
+        '''
+        :param sql_cache: see :py:class:`SQLCache`
+        :param compress: compression method for :py:func:`package_extract`,
+                         or None to leave extracts uncompressed
+        :param remove: to remove uncompressed files once packaged;
+                       see :py:func:`package_extract`
+        :param shards: number of files to split patients across;
+                       see :py:class:`ShardedDest`
+        :param dest_opts: keyword arguments for :py:class:`DataDest`
+        :raises ValueError: for an unknown `compress` method or a
+                            number of `shards` that can't be attached
+        '''
+        if compress and compress not in pack_suffixes:
+            raise ValueError('unknown compress method: %s (expected %s)' % (
+                compress, ' or '.join(sorted(pack_suffixes))))
+        if not 1 <= shards <= ShardedDest.max_shards:
+            raise ValueError('shards must be from 1 to %d: %s' % (
+                ShardedDest.max_shards, shards))
+
         def user_access(username):
             cdw_account = db_access(cdw_config=cdw_section)
 
@@ -748,37 +2721,343 @@ class BuilderApp(object):
                 out = work_dir / (name + ext)
                 return db_access(on=out), out
 
-            return cdw_account, job_storage  # TODO: mailer?
+            def job_file(name, suffix):
+                return work_dir / (name + ext + suffix)
+
+            return cdw_account, job_storage, job_file  # TODO: mailer?
 
-        return BuilderApp(user_access)
+        return BuilderApp(user_access, dest_opts, sql_cache, compress, shards,
+                          remove)
 
-    def __call__(self, username, label, concepts, filename, patient_set):
+    def __call__(self, username, label, concepts, filename, patient_set,
+                 filters=None):
         '''
         :param String username: the user requesting the data extract
         :param String label: i2b2 patient set label
         :param String concepts: json-encoded data variables
         :param String filename: the filename of the resulting data extract
-        :param String patient_set: patient_set id (numeral)
+        :param String patient_set: patient_set id (numeral), or a list
+                                   of them to extract together
+        :param filters: optional fact filters; see
+                        :py:meth:`DataExtract.filter_binds`
 
         :rtype: Iterable[String]
         '''
-        account, job_storage = self._access(username)
-
-        db, storage = job_storage(filename)
-        dest = DataDest(db, storage.ro().fullPath())
+        job, dest, package = self._prepare(
+            username, label, concepts, filename, patient_set, filters)
         try:
-            job = DataExtract(account, username,
-                              label, concepts, patient_set, filename)
             out = dest.export(job)
+            package(out)
         except IOError as ex:
             log.critical('Error building data:', exc_info=ex)
             return ['error:', str(ex)]
 
         return [json.dumps(out)]
 
+    def batch(self, requests):
+        '''Build several data files, sharing fact scans where possible.
+
+        Requests with the same filters are exported together, with one
+        query of `observation_fact` for the union of their concepts and
+        patient sets (see :py:meth:`DataDest.export_batch`), so load on
+        the CDW grows with the facts requested rather than the number
+        of jobs. Sharded jobs are exported one at a time.
+
+        A failure in one group of requests doesn't stop the others;
+        each request in that group gets an error result.
+
+        :param requests: argument tuples, as for :py:meth:`__call__`
+        :return: results, as from :py:meth:`__call__`, for each request
+        '''
+        results = [None] * len(requests)
+        prepared = {}
+        for (ix, request) in enumerate(requests):
+            try:
+                prepared[ix] = self._prepare(*request)
+            except Exception as ex:
+                log.critical('Error preparing %s:', request[3], exc_info=ex)
+                results[ix] = ['error:', str(ex)]
+        groups = {}
+        for (ix, (job, dest, _package)) in sorted(prepared.items()):
+            key = (json.dumps(job.filters, sort_keys=True)
+                   if type(dest) is DataDest else ix)
+            groups.setdefault(key, []).append(ix)
+
+        for ixs in sorted(groups.values()):
+            log.info('exporting %d job(s) together', len(ixs))
+            try:
+                if len(ixs) == 1:
+                    (job, dest, _package) = prepared[ixs[0]]
+                    outs = [dest.export(job)]
+                else:
+                    outs = DataDest.export_batch(
+                        [prepared[ix][:2] for ix in ixs])
+                for (ix, out) in zip(ixs, outs):
+                    prepared[ix][2](out)
+                    results[ix] = [json.dumps(out)]
+            except Exception as ex:
+                log.critical('Error building data:', exc_info=ex)
+                for ix in ixs:
+                    results[ix] = results[ix] or ['error:', str(ex)]
+        return results
+
+    def _prepare(self, username, label, concepts, filename, patient_set,
+                 filters=None):
+        '''
+        :return: job, destination, and a function to package the results
+        '''
+        account, job_storage, job_file = self._access(username)
+
+        db, storage = job_storage(filename)
+        shards = [job_storage('%s.shard%d' % (filename, ix))
+                  for ix in range(self._shards)] if self._shards > 1 else []
+        if shards:
+            dest = ShardedDest(db, storage.ro().fullPath(),
+                               [(shard_db, shard.ro().fullPath())
+                                for (shard_db, shard) in shards],
+                               **self._dest_opts)
+        else:
+            dest = DataDest(db, storage.ro().fullPath(), **self._dest_opts)
+        job = DataExtract(account, username,
+                          label, concepts, patient_set, filename,
+                          filters, self._sql_cache)
+
+        def package(out):
+            if not self._compress:
+                return
+            out['package'] = package_extract(
+                db, storage.ro(),
+                lambda suffix: job_file(filename, suffix),
+                job_file(filename, '.manifest.json'), self._compress,
+                remove=self._remove)
+            out['package']['shards'] = [
+                package_extract(
+                    shard_db, shard.ro(),
+                    lambda suffix, name='%s.shard%d' % (filename, ix):
+                    job_file(name, suffix),
+                    job_file('%s.shard%d' % (filename, ix),
+                             '.manifest.json'),
+                    self._compress, remove=self._remove)
+                for (ix, (shard_db, shard)) in enumerate(shards)]
+        return job, dest, package
+
+
+@contextmanager
+def _no_phase(what):
+    yield
+
+
+class JobProfiler(object):
+    '''Opt-in profiling of a job, with reports kept for later diagnosis.
+
+    Each phase of the export is timed, with the process's resident
+    set size (RSS) at its end and how much the phase raised the peak
+    RSS; optionally the whole job runs under cProfile. Reports go in
+    `out_dir`,
+    normally next to the job request and log, as
+    ``<job>.<timestamp>.prof`` (for :py:mod:`pstats`) and
+    ``<job>.<timestamp>.profile.txt``; the oldest reports are removed
+    to keep their total size under `max_bytes`.
+
+    >>> import os, tempfile
+    >>> out_dir = tempfile.mkdtemp()
+    >>> profiler = JobProfiler(os, open, out_dir, 'job1', cprofile=True)
+    >>> def job():
+    ...     with profiler.phase('export_data'):
+    ...         return sum(range(1000))
+    >>> profiler.run(job)
+    499500
+    >>> sorted(name.split('.', 2)[2] for name in os.listdir(out_dir))
+    ['prof', 'profile.txt']
+    >>> report = open(os.path.join(out_dir, [
+    ...     name for name in os.listdir(out_dir)
+    ...     if name.endswith('.txt')][0])).read()
+    >>> 'export_data' in report
+    True
+    >>> ' RSS ' in report, ' peak +' in report
+    (True, True)
+    '''
+    env_key = 'DFBUILD_PROFILE'
+    suffixes = ('.prof', '.profile.txt')
+
+    def __init__(self, os, openf, out_dir, job_name,
+                 cprofile=False,
+                 max_bytes=100 * 1024 * 1024):
+        self._os = os
+        self._openf = openf
+        self._out_dir = out_dir
+        self._job_name = job_name
+        self._cprofile = cprofile
+        self._max_bytes = max_bytes
+        self._report = []
+
+    @classmethod
+    def make(cls, os, openf, environ, section, request_path, job_name):
+        '''Make a profiler if the environment or config asks for one.
+
+        :param section: ``[profile]`` config section, with optional
+                        flags `cprofile` and `phases` (phase timing
+                        and RSS only), `dir` and `max_mb`
+        :return: a JobProfiler, or None
+        '''
+        wanted = set(part.strip() for part in
+                     environ.get(cls.env_key, '').split(',') if part.strip())
+        for option in ['cprofile', 'phases']:
+            if config_flag(section, option):
+                wanted.add(option)
+        if not wanted:
+            return None
+
+        out_dir = config_get(section, 'dir') or os.path.dirname(
+            os.path.abspath(request_path))
+        max_mb = int(config_get(section, 'max_mb', 100))
+        return cls(os, openf, out_dir, job_name,
+                   cprofile='cprofile' in wanted,
+                   max_bytes=max_mb * 1024 * 1024)
+
+    @contextmanager
+    def phase(self, what):
+        t0 = time.time()
+        peak0 = _peak_rss()
+        try:
+            yield
+        finally:
+            line = '%-20s %8.1fs  RSS %s  peak +%s' % (
+                what, time.time() - t0, human_size(self._current_rss()),
+                human_size(_peak_rss() - peak0))
+            log.info('phase %s', line)
+            self._report.append(line)
+
+    def _current_rss(self):
+        '''Current resident set size of this process, in bytes.
+
+        Only Linux has ``/proc/self/statm``; elsewhere, this is 0.
+        '''
+        try:
+            with self._openf('/proc/self/statm') as statm:
+                pages = int(statm.read().split()[1])
+            return pages * self._os.sysconf('SC_PAGE_SIZE')
+        except (IOError, OSError, ValueError, IndexError):
+            return 0
+
+    def run(self, thunk):
+        '''Run `thunk()` under the configured profilers; save reports.
+        '''
+        prof = None
+        if self._cprofile:
+            import cProfile
+            prof = cProfile.Profile()
+            prof.enable()
+        try:
+            return thunk()
+        finally:
+            if prof:
+                prof.disable()
+            self._save(prof)
+
+    def _save(self, prof):
+        os = self._os
+        stem = os.path.join(self._out_dir, '%s.%s' % (
+            self._job_name, time.strftime('%Y%m%dT%H%M%S')))
+        try:
+            if prof:
+                prof.create_stats()
+                with self._openf(stem + '.prof', 'wb') as out:
+                    marshal.dump(prof.stats, out)
+            with self._openf(stem + '.profile.txt', 'w') as out:
+                out.write('\n'.join(self._report) + '\n')
+            log.info('profile saved: %s.*', stem)
+            self._prune(keep=[stem + suffix for suffix in self.suffixes])
+        except (IOError, OSError) as ex:
+            log.warning('cannot save profile:', exc_info=ex)
+
+    def _prune(self, keep):
+        os = self._os
+        reports = [os.path.join(self._out_dir, name)
+                   for name in os.listdir(self._out_dir)
+                   if name.endswith(self.suffixes)]
+        reports.sort(key=os.path.getmtime, reverse=True)
+        total = 0
+        for path in reports:
+            total += os.path.getsize(path)
+            if total > self._max_bytes and path not in keep:
+                log.info('removing old profile: %s', path)
+                os.remove(path)
+
+
+def _peak_rss():
+    '''Peak resident set size of this process so far, in bytes.'''
+    if resource is None:
+        return 0
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return kb * 1024
+
+
+def config_get(section, option,
+               default=None):
+    '''Get an optional setting.
+    '''
+    try:
+        return section.get(option)
+    except (NoOptionError, NoSectionError):
+        return default
+
+
+def config_int(section, option,
+               default=None):
+    '''Get an optional integer setting.
+
+    >>> from ConfigParser import SafeConfigParser
+    >>> cp = SafeConfigParser()
+    >>> cp.add_section('output')
+    >>> cp.set('output', 'shards', 'four')
+    >>> import os
+    >>> fs = lafile.Readable('/', os.path, os.listdir, open)
+    >>> output = lafile.ConfigRd(cp, fs) / 'output'
+    >>> config_int(output, 'shards', 1)
+    Traceback (most recent call last):
+      ...
+    ValueError: shards must be an integer: 'four'
+    >>> config_int(output, 'no_such_option', 1)
+    1
+
+    :raises ValueError: naming the setting, if it isn't an integer
+    '''
+    value = config_get(section, option)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('%s must be an integer: %r' % (option, value))
+
+
+def config_flag(section, option,
+                default=False):
+    '''Get an optional boolean setting.
+
+    >>> from ConfigParser import SafeConfigParser
+    >>> cp = SafeConfigParser()
+    >>> cp.add_section('output')
+    >>> cp.set('output', 'concurrent_export', 'yes')
+    >>> import os
+    >>> fs = lafile.Readable('/', os.path, os.listdir, open)
+    >>> output = lafile.ConfigRd(cp, fs) / 'output'
+
+    >>> config_flag(output, 'concurrent_export')
+    True
+    >>> config_flag(output, 'no_such_option')
+    False
+    '''
+    value = config_get(section, option)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'yes', 'true', 'on')
+
 
 def send_completion_mail(smtp, email_config, username, gethostname, filename,
-                         home_dirs, summary):
+                         home_dirs, summary,
+                         package=None, stats=None):
     '''
     Config Setup
     >>> from ConfigParser import SafeConfigParser
@@ -797,7 +3076,7 @@ def send_completion_mail(smtp, email_config, username, gethostname, filename,
     >>> gethostname = lambda : 'mock_host'
 
     Mock SMTP
-    >>> mocksmtp = MockSMTP()
+    >>> mocksmtp = emailer.MockSMTP()
 
     Sending completion email
     >>> send_completion_mail(mocksmtp, config_dir / 'email', 'somebody',
@@ -821,6 +3100,26 @@ def send_completion_mail(smtp, email_config, username, gethostname, filename,
     ====DATA SUMMARY====
     some summary
 
+    When the extract was packaged, we say how big it is:
+
+    >>> package = dict(packed_filename='/home/somebody/data.db.gz',
+    ...                method='gzip', size=3 * 1024 ** 3,
+    ...                packed_size=400 * 1024 ** 2, packed_sha256='abc123')
+    >>> mocksmtp = emailer.MockSMTP()
+    >>> send_completion_mail(mocksmtp, config_dir / 'email', 'somebody',
+    ...                      gethostname, 'data.db',
+    ...                      (config_dir / 'output' / 'home_dirs').fullPath(),
+    ...                      'some summary', package)
+    ... # doctest: +ELLIPSIS
+    MockSMTP:sendmail()
+    ...
+    ====DATA SUMMARY====
+    some summary
+    <BLANKLINE>
+    ====COMPRESSED COPY====
+    /home/somebody/data.db.gz (gzip): 400.0 MB; uncompressed: 3.0 GB
+    sha256: abc123
+
     Modify sendmail to raise an IOError
     >>> def sendmailex(sender, receiver, msg):
     ...     raise IOError
@@ -834,14 +3133,6 @@ def send_completion_mail(smtp, email_config, username, gethostname, filename,
     ...                      'some summary')
     '''
     if email_config.exists():
-        domain = email_config.get('user_domain')
-
-        #TODO get actual users email (from json)
-        #It is an unfortunate hack that we use the [username]+[config domain]
-        recipient = '{0}@{1}'.format(username, domain)
-        recipient = 'bos@uthscsa.edu,bokov@uthscsa.edu'
-        emailer = Emailer(smtp, lambda: [r for r in recipient.split(',')])
-
         message_kwds = {'filename': filename,
                         'hostname': gethostname(),
                         'location': '%s/%s' % (home_dirs, username),
@@ -849,43 +3140,326 @@ def send_completion_mail(smtp, email_config, username, gethostname, filename,
         body = 'The dataset {filename} is now available on {hostname} ' \
                'at \'{location}\'' \
                '\n\n====DATA SUMMARY====\n{summary}'.format(**message_kwds)
+        if stats:
+            body += '\n\n====VARIABLE STATISTICS====\n' + stats
+        if package:
+            parts = [package] + package.get('shards', [])
+            body += ('\n\n====COMPRESSED COPY====\n' + '\n'.join(
+                ('{packed_filename} ({method}): {packed}; '
+                 'uncompressed: {plain}\n'
+                 'sha256: {packed_sha256}').format(
+                     packed=human_size(part['packed_size']),
+                     plain=human_size(part['size']),
+                     **part)
+                for part in parts))
         subject = 'The dataset \'{filename}\' is now available'.format(
             **message_kwds)
 
-        sender = email_config.get('sender')
-        log.info('dfbuilder.py:send_completion_mail()\n From: %s\n To: %s'
-                 % (sender, recipient))
-        try:
-            emailer.sendEmail(body, subject, sender)
-        except Exception as ex:
-            log.warning('Exception sending e-mail!',
-                        exc_info=ex)
+        _send_mail(smtp, email_config, username, subject, body)
 
 
-def main(argv, arg_rd, db_access, config_arg1, getuser, smtp, gethostname):
+def send_rejection_mail(smtp, email_config, username, filename, reason):
+    '''Tell the user why their request could not be run.
+
+    >>> from ConfigParser import SafeConfigParser
+    >>> cp = SafeConfigParser()
+    >>> cp.add_section('email')
+    >>> cp.set('email', 'user_domain', 'kumc.edu')
+    >>> cp.set('email', 'sender', 'nobody@kumc.edu')
+    >>> import os
+    >>> fs = lafile.Readable('/', os.path, os.listdir, open)
+    >>> config_dir = lafile.ConfigRd(cp, fs)
+    >>> send_rejection_mail(emailer.MockSMTP(), config_dir / 'email',
+    ...                     'somebody', 'data.db', 'latest_n must be at least 1')
+    ... # doctest: +ELLIPSIS
+    MockSMTP:sendmail()
+    ...
+    Subject: The dataset 'data.db' could not be built
+    ...
+    Your request for data.db was not run: latest_n must be at least 1
+    '''
+    if email_config.exists():
+        subject = 'The dataset \'{0}\' could not be built'.format(filename)
+        body = 'Your request for {0} was not run: {1}'.format(filename, reason)
+        _send_mail(smtp, email_config, username, subject, body)
+
+
+def send_failure_mail(smtp, email_config, username, filename):
+    '''Tell the user their request failed.
+
+    >>> from ConfigParser import SafeConfigParser
+    >>> cp = SafeConfigParser()
+    >>> cp.add_section('email')
+    >>> cp.set('email', 'user_domain', 'kumc.edu')
+    >>> cp.set('email', 'sender', 'nobody@kumc.edu')
+    >>> import os
+    >>> fs = lafile.Readable('/', os.path, os.listdir, open)
+    >>> config_dir = lafile.ConfigRd(cp, fs)
+    >>> send_failure_mail(emailer.MockSMTP(), config_dir / 'email',
+    ...                   'somebody', 'data.db')
+    ... # doctest: +ELLIPSIS
+    MockSMTP:sendmail()
+    ...
+    Subject: The dataset 'data.db' could not be built
+    ...
+    Building data.db failed; the error has been logged for the
+    administrators.
+    '''
+    if email_config.exists():
+        subject = 'The dataset \'{0}\' could not be built'.format(filename)
+        body = ('Building {0} failed; the error has been logged for the\n'
+                'administrators.'.format(filename))
+        _send_mail(smtp, email_config, username, subject, body)
+
+
+def _send_mail(smtp, email_config, username, subject, body):
+    domain = email_config.get('user_domain')
+
+    #TODO get actual users email (from json)
+    #It is an unfortunate hack that we use the [username]+[config domain]
+    recipient = '{0}@{1}'.format(username, domain)
+    recipient = 'bos@uthscsa.edu,bokov@uthscsa.edu'
+    mailer = emailer.Emailer(smtp,
+                             lambda: [r for r in recipient.split(',')])
+
+    sender = email_config.get('sender')
+    log.info('dfbuilder.py:_send_mail()\n From: %s\n To: %s'
+             % (sender, recipient))
+    try:
+        mailer.sendEmail(body, subject, sender)
+    except Exception as ex:
+        log.warning('Exception sending e-mail!',
+                    exc_info=ex)
+
+
+class RequestQueue(object):
+    '''Job requests waiting in one directory, to be run together.
+
+    Each request starts its own process, which claims requests by
+    renaming them, from ``.json`` to ``.json.batched``; only one
+    process can rename a given file, so each request runs once.
+    Without a batching window, a process claims just its own request;
+    with one, it waits, then claims every request queued by then.
+
+    >>> import os, tempfile
+    >>> queue_dir = tempfile.mkdtemp()
+    >>> for name in ['job1.json', 'job2.json', 'notes.json']:
+    ...     with open(os.path.join(queue_dir, name), 'w') as out:
+    ...         json.dump(dict(patient_set=123) if 'job' in name else [],
+    ...                   out)
+    >>> waits = []
+    >>> queue = RequestQueue(os, open, waits.append, queue_dir)
+    >>> claimed = queue.collect(30)
+    >>> waits, [prefix for (_request, prefix) in claimed]
+    ([30], ['job1', 'job2'])
+    >>> json.load(claimed[0][0].inChannel())
+    {u'patient_set': 123}
+
+    The process started for `job2` finds nothing left to run:
+
+    >>> RequestQueue(os, open, waits.append, queue_dir).collect(30)
+    []
+
+    Once a request has run (or failed, and its user has been told), it
+    is renamed again, to ``.json.done``, so it is never claimed again.
+    A claimed request that wasn't run, say because of an error that
+    stopped the process, is put back in the queue:
+
+    >>> queue.done('job1')
+    >>> queue.release()
+    >>> sorted(os.listdir(queue_dir))
+    ['job1.json.done', 'job2.json', 'notes.json']
+    >>> [prefix for (_request, prefix)
+    ...  in RequestQueue(os, open, waits.append, queue_dir).claim(
+    ...      ['job1.json', 'job2.json'])]
+    ['job2']
+    '''
+    claimed_suffix = '.batched'
+    done_suffix = '.done'
+
+    def __init__(self, os, openf, sleep, queue_dir):
+        '''
+        :param os: for `listdir` and `rename` in `queue_dir`
+        :param sleep: to wait out the batching window
+        '''
+        self._os = os
+        self._openf = openf
+        self._sleep = sleep
+        self._queue_dir = queue_dir
+        self._rd = lafile.Readable(queue_dir, os.path, os.listdir, openf)
+        self._claimed = {}
+
+    def collect(self, window):
+        '''Wait `window` seconds for more requests; then claim them all.
+
+        :return: as from :py:meth:`claim`
+        '''
+        self._sleep(window)
+        return self.claim(sorted(self._os.listdir(self._queue_dir)))
+
+    def claim(self, names):
+        '''Claim the named requests that are still queued.
+
+        Files that aren't (yet) complete job requests are left alone.
+
+        :return: (readable, prefix) for each request claimed,
+                 as for :py:func:`_run_job`
+        '''
+        os = self._os
+        claimed = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self._queue_dir, name)
+            try:
+                with self._openf(path) as request:
+                    if 'patient_set' not in json.load(request):
+                        continue
+                os.rename(path, path + self.claimed_suffix)
+            except (IOError, OSError, ValueError, TypeError) as ex:
+                log.info('not claiming %s: %s', name, ex)
+                continue
+            prefix = name.split('.json')[0]
+            self._claimed[prefix] = path
+            claimed.append((self._rd / (name + self.claimed_suffix), prefix))
+        log.info('claimed %d queued request(s)', len(claimed))
+        return claimed
+
+    def done(self, prefix):
+        '''Mark a claimed request as run.'''
+        path = self._claimed.pop(prefix)
+        self._os.rename(path + self.claimed_suffix, path + self.done_suffix)
+
+    def release(self):
+        '''Put claimed requests that weren't run back in the queue.'''
+        for (prefix, path) in sorted(self._claimed.items()):
+            log.warning('request %s was not run; requeueing it', prefix)
+            self._os.rename(path + self.claimed_suffix, path)
+        self._claimed = {}
+
+
+def main(argv, arg_rd, db_access, config_arg1, getuser, smtp, gethostname,
+         mk_profiler=None, mk_sql_cache=None, mk_queue=None, rm=None):
+    '''
+    :param mk_profiler: given the ``[profile]`` config section, the
+                        request filename and job name, make a
+                        :py:class:`JobProfiler` or return None
+    :param mk_sql_cache: given the ``sql_cache`` store, make a
+                         :py:class:`SQLCache`; without it, SQL is
+                         not cached
+    :param mk_queue: given a request filename, make a
+                     :py:class:`RequestQueue` of its directory (where
+                     all of the requests given must be); without it,
+                     requests aren't claimed and ``batch_window``
+                     is ignored
+    :param rm: to remove a file, given its full path; without it,
+               ``remove_uncompressed`` is ignored
+    '''
     config = config_arg1()
-    _config_fn, request_fn = argv[1:3]
+    log.info('startup took %.3fs', time.time() - _loaded_at)
+    request_fns = argv[2:]
+
+    requests = [(arg_rd / request_fn,
+                 request_fn.split('/')[-1].split('.json')[0])
+                for request_fn in request_fns]
+    queue = mk_queue(request_fns[0]) if mk_queue else None
+    if queue:
+        window = config_int((config / 'output').ro(), 'batch_window', 0)
+        requests = (queue.collect(window) if window else
+                    queue.claim([fn.split('/')[-1] for fn in request_fns]))
+        if not requests:
+            log.info('already claimed by another process: %s', request_fns)
+            return
+    done = queue.done if queue else None
+
+    profiler = mk_profiler and mk_profiler((config / 'profile').ro(),
+                                           request_fns[0], requests[0][1])
+    try:
+        if profiler:
+            profiler.run(lambda: _run_job(config, requests,
+                                          db_access, smtp, gethostname,
+                                          profiler.phase, mk_sql_cache, rm,
+                                          done))
+        else:
+            _run_job(config, requests,
+                     db_access, smtp, gethostname,
+                     mk_sql_cache=mk_sql_cache, rm=rm, done=done)
+    finally:
+        if queue:
+            queue.release()
 
-    request_readable = arg_rd / request_fn
+
+def _run_job(config, requests,
+             db_access, smtp, gethostname,
+             phase=None, mk_sql_cache=None, rm=None, done=None):
+    '''
+    :param requests: (readable, prefix) for each job request; jobs
+                     requested together share fact scans
+                     (see :py:meth:`BuilderApp.batch`)
+    :param done: called with the prefix of each request once it has
+                 run, or failed, and its user has been told
+    '''
+    done = done or (lambda prefix: None)
     home_dirs = config / 'output' / 'home_dirs'
-    prefix = request_fn.split('/')[-1].split('.json')[0]
 
-    builder = BuilderApp.make(config.ro() / DataExtract.cdw_section,
-                              db_access, home_dirs)
+    output = (config / 'output').ro()
+    sql_cache = (mk_sql_cache(config / 'output' / 'sql_cache')
+                 if mk_sql_cache and config_get(output, 'sql_cache')
+                 else None)
+    builder = BuilderApp.make(
+        config.ro() / DataExtract.cdw_section,
+        db_access, home_dirs, sql_cache=sql_cache,
+        compress=config_get(output, 'compress'),
+        remove=rm if config_flag(output, 'remove_uncompressed') else None,
+        shards=config_int(output, 'shards', 1),
+        concurrent=config_flag(output, 'concurrent_export'),
+        pipelined=config_flag(output, 'pipelined_copy'),
+        phase=phase,
+        stats=config_flag(output, 'variable_stats'))
 
     # todo: static types?
-    params = json.load(request_readable.inChannel())
-    concepts = params['concepts']
-    patient_set = params['patient_set']
-    username = params['username']
-    #filename = params['filename']
-    filename = '%s_%s' % (prefix, params['filename'])
-    builder_json = builder(username, params['label'], concepts,
-                           filename, patient_set)
-
-    summary = json.loads(builder_json[0])['str']
-    send_completion_mail(smtp, (config / 'email').ro(), username, gethostname,
-                         filename, home_dirs.ro().fullPath(), summary)
+    args, prefixes = [], []
+    for (request_readable, prefix) in requests:
+        try:
+            params = json.load(request_readable.inChannel())
+        except ValueError as ex:
+            log.error('cannot read request %s: %s', prefix, ex)
+            done(prefix)
+            continue
+        concepts = params['concepts']
+        patient_set = params['patient_set']
+        username = params['username']
+        #filename = params['filename']
+        filename = '%s_%s' % (prefix, params['filename'])
+        filters = dict((k, params[k]) for k in DataExtract.filter_keys
+                       if params.get(k))
+        try:
+            DataExtract.check_filters(filters)
+        except ValueError as ex:
+            log.error('rejecting request %s: %s', prefix, ex)
+            send_rejection_mail(smtp, (config / 'email').ro(), username,
+                                filename, str(ex))
+            done(prefix)
+            continue
+        args.append((username, params['label'], concepts,
+                     filename, patient_set, filters))
+        prefixes.append(prefix)
+    if not args:
+        return
+    results = builder.batch(args)
+
+    for (arg, prefix, builder_json) in zip(args, prefixes, results):
+        (username, _label, _concepts, filename, _ps, _filters) = arg
+        if builder_json[0] == 'error:':
+            send_failure_mail(smtp, (config / 'email').ro(), username,
+                              filename)
+        else:
+            built = json.loads(builder_json[0])
+            send_completion_mail(smtp, (config / 'email').ro(), username,
+                                 gethostname, filename,
+                                 home_dirs.ro().fullPath(), built['str'],
+                                 built.get('package'), built.get('stats'))
+        done(prefix)
 
 
 def mk_db_access(create_engine):
@@ -956,6 +3530,14 @@ if __name__ == '__main__':
              config_arg1=config_arg1,
              getuser=getuser,
              smtp=SMTP(),
-             gethostname=socket.gethostname)
+             gethostname=socket.gethostname,
+             mk_profiler=lambda section, request_fn, job_name:
+             JobProfiler.make(os, openf, environ, section,
+                              request_fn, job_name),
+             mk_sql_cache=lambda store: SQLCache.on(store, os, openf),
+             mk_queue=lambda request_fn: RequestQueue(
+                 os, openf, time.sleep,
+                 os.path.dirname(os.path.abspath(request_fn))),
+             rm=os.remove)
 
     _trusted_main()
@@ -0,0 +1,473 @@
+r'''extract_reader -- paged, read-only queries of finished data extracts
+.......................................................................
+
+Rather than copy a whole extract to their own machine to check a few
+variables or patients, users can page through slices of it::
+
+  GET /<extract>/variables
+  GET /<extract>/patients?patient=1&patient=2
+  GET /<extract>/facts?variable=0&start_date=2010-01-01&format=csv
+
+where `<extract>` is the name of a finished data file built by
+:py:mod:`dfbuilder` (e.g. ``job1_cohort.db``) in the `home_dirs`
+directory of the authenticated user (``REMOTE_USER``). The patients
+and facts of a sharded extract are in its shards
+(e.g. ``job1_cohort.shard0.db``); see :py:class:`dfbuilder.ShardedDest`.
+
+Query parameters:
+
+  - ``variable``: id from `variables`; facts under its concept path
+  - ``patient``: `patient_num`
+  - ``start_date``, ``end_date``: ``YYYY-MM-DD``, inclusive
+  - ``after``: ``next`` from the previous page (for CSV, the
+    `row_id` of its last row)
+  - ``limit``: rows per page, from 1 up to
+    :py:attr:`ExtractReader.max_limit`
+  - ``format``: ``json`` (the default) or ``csv``
+
+Pages are keyed by `rowid` rather than offset, so each one is a range
+scan however deep it is; filters use the indexes that
+:py:class:`dfbuilder.DataDest` creates. Results are streamed.
+
+Usage, as a CGI script alongside the Data Builder's::
+
+   $ DFBUILD_CONFIG=dfbuild.conf python cdr2edc/extract_reader.py
+
+Under a WSGI server, use :py:meth:`ExtractReader.make` so that open
+extracts are cached across requests.
+
+
+Let's make an extract with a few facts:
+
+    >>> import os, tempfile
+    >>> from sqlalchemy import create_engine
+    >>> work = tempfile.mkdtemp()
+    >>> os.mkdir(os.path.join(work, 'me'))
+    >>> db = create_engine('sqlite:///' + os.path.join(work, 'me', 'job1.db'))
+    >>> for sql in [
+    ...     'create table variable (id, concept_path, name_char)',
+    ...     'create table concept_dimension (concept_path, concept_cd)',
+    ...     'create table patient_dimension (patient_num, sex_cd)',
+    ...     'create table observation_fact (patient_num, concept_cd,'
+    ...     ' start_date, nval_num)',
+    ...     'create table job (finished)']:
+    ...     _ = db.execute(sql)
+    >>> _ = db.execute("insert into job values ('2010-02-01 12:00:00')")
+    >>> _ = db.execute("insert into variable values (0, '\\\\lab\\\\', 'Lab')")
+    >>> _ = db.execute("insert into concept_dimension"
+    ...                " values ('\\\\lab\\\\a\\\\', 'A')")
+    >>> _ = db.execute("insert into patient_dimension values (1, 'f')")
+    >>> for (pat, cd, day) in [(1, 'A', 1), (2, 'A', 2), (1, 'B', 3),
+    ...                        (1, 'A', 4)]:
+    ...     _ = db.execute('insert into observation_fact values (?, ?, ?, ?)',
+    ...                    pat, cd, '2010-01-%02d 00:00:00.000000' % day, day)
+
+Each user sees the extracts in their home directory:
+
+    >>> reader = ExtractReader(lafile.Readable(work, os.path, os.listdir, open),
+    ...                        create_engine, os.path.getmtime)
+    >>> def get(path, query='', user='me'):
+    ...     def start_response(status, headers):
+    ...         print status, dict(headers)['Content-Type']
+    ...     print ''.join(reader(dict(REMOTE_USER=user, PATH_INFO=path,
+    ...                               QUERY_STRING=query),
+    ...                          start_response))
+
+    >>> get('/job1.db/facts', 'variable=0&patient=1&limit=1')
+    200 OK application/json
+    {"rows": [
+    {"concept_cd": "A", "nval_num": 1, "patient_num": 1, "row_id": 1, "start_date": "2010-01-01 00:00:00.000000"}],
+     "next": 1}
+    >>> get('/job1.db/facts', 'variable=0&patient=1&after=1&format=csv')
+    200 OK text/csv; charset=utf-8
+    row_id,patient_num,concept_cd,start_date,nval_num
+    4,1,A,2010-01-04 00:00:00.000000,4
+    <BLANKLINE>
+
+Pages past the end have no `next`; bad requests get errors:
+
+    >>> get('/job1.db/facts', 'end_date=2010-01-01')
+    ... # doctest: +ELLIPSIS
+    200 OK application/json
+    {"rows": [
+    {"concept_cd": "A", ..., "row_id": 1, ...}],
+     "next": null}
+    >>> get('/job1.db/facts', 'patient=x')
+    400 Bad Request application/json
+    {"error": "invalid literal for int() with base 10: 'x'"}
+    >>> get('/job1.db/facts', 'limit=-1')
+    400 Bad Request application/json
+    {"error": "limit must be at least 1: -1"}
+    >>> get('/../facts')
+    404 Not Found application/json
+    {"error": "no such extract"}
+    >>> get('/job1.db/facts', user='you')
+    404 Not Found application/json
+    {"error": "no such extract"}
+
+Only ``.db`` files are extracts; one that isn't finished (or isn't
+an extract at all) isn't served:
+
+    >>> open(os.path.join(work, 'me', 'job1.db.gz'), 'w').close()
+    >>> get('/job1.db.gz/facts')
+    404 Not Found application/json
+    {"error": "no such extract"}
+    >>> _ = create_engine('sqlite:///' + os.path.join(work, 'me', 'job2.db')
+    ...                   ).execute('create table job (finished)')
+    >>> get('/job2.db/facts')
+    409 Conflict application/json
+    {"error": "extract is not finished"}
+    >>> with open(os.path.join(work, 'me', 'notes.db'), 'w') as out:
+    ...     out.write('not a database' * 100)
+    >>> get('/notes.db/facts')
+    400 Bad Request application/json
+    {"error": "not a readable extract: file is not a database"}
+
+Extracts are opened read-only, by way of a ``mode=ro`` URI where
+SQLite supports them (see :py:func:`uri_filenames`), or else with the
+`query_only` pragma:
+
+    >>> reader._open('me', 'job1.db').execute('delete from variable')
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+      ...
+    OperationalError: ... attempt to write a readonly database...
+    >>> ExtractReader(lafile.Readable(work, os.path, os.listdir, open),
+    ...               create_engine, os.path.getmtime, uri=False
+    ...               )._open('me', 'job1.db').execute('delete from variable')
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+      ...
+    OperationalError: ... attempt to write a readonly database...
+'''
+
+import csv
+import json
+import logging
+import re
+import sqlite3
+from StringIO import StringIO
+from collections import OrderedDict
+from threading import Lock
+from urllib import quote
+from urlparse import parse_qs
+
+from sqlalchemy import pool
+from sqlalchemy.engine.url import URL as DBURL
+from sqlalchemy.exc import DatabaseError
+from sqlalchemy.sql import text
+
+from ocap import lafile
+
+from dfbuilder import DataDest, DataExtract, config_get
+
+log = logging.getLogger('extract_reader')
+
+_NAME = re.compile(r'^\w[\w.@-]*$')
+_EXTRACT = re.compile(r'^\w[\w.@-]*\.db$')
+
+
+def uri_filenames(connect=sqlite3.connect):
+    '''Does SQLite take ``file:`` URIs as filenames?
+
+    Python 2's `sqlite3` has no ``uri=True``, so only if SQLite was
+    built with ``SQLITE_USE_URI``; otherwise, it would open (or create)
+    a file named after the whole URI.
+
+    >>> uri_filenames() in (True, False)
+    True
+    '''
+    conn = connect(':memory:')
+    try:
+        return 'USE_URI' in [opt for (opt, ) in conn.execute(
+            'pragma compile_options')]
+    finally:
+        conn.close()
+
+
+class ExtractReader(object):
+    '''WSGI app to serve pages of data extracts.
+
+    Extracts are opened read-only (``mode=ro``, or failing that,
+    ``query_only``), with SQLite's
+    `mmap_size` pragma, once their `job` is marked finished (see
+    :py:class:`dfbuilder.DataDest`); engines (with their connection
+    pools) are cached per file, up to `max_open` of them, until the
+    file changes.
+    '''
+    default_limit = 100
+    max_limit = 5000
+
+    # what: (table, alias, query parameters that apply)
+    pages = dict(
+        variables=('variable', 'v', ['variable']),
+        patients=('patient_dimension', 'p', ['patient']),
+        facts=('observation_fact', 'f',
+               ['variable', 'patient', 'start_date', 'end_date']))
+
+    def __init__(self, home_dirs, create_engine, getmtime,
+                 max_open=16, mmap_size=256 * 1024 * 1024, uri=None):
+        '''
+        :param home_dirs: lafile.Readable of users' directories
+        :param getmtime: as from `os.path`, to notice rebuilt extracts
+        :param uri: whether to open extracts by ``file:`` URI;
+                    by default, if :py:func:`uri_filenames`
+        '''
+        cache = OrderedDict()
+        lock = Lock()
+        if uri is None:
+            uri = uri_filenames()
+            if not uri:
+                log.warning('SQLite was built without SQLITE_USE_URI;'
+                            ' opening extracts with query_only')
+
+        def read_only(path):
+            def connect():
+                if uri:
+                    conn = sqlite3.connect('file:%s?mode=ro' % quote(path),
+                                           check_same_thread=False)
+                else:
+                    conn = sqlite3.connect(path, check_same_thread=False)
+                    conn.execute('pragma query_only = 1')
+                conn.execute('pragma mmap_size = %d' % mmap_size)
+                return conn
+            return connect
+
+        def open_extract(username, name):
+            '''
+            :return: an engine, or None if the extract isn't finished
+            :raises LookupError: if there's no such extract
+            :raises DatabaseError: if it isn't a readable extract
+            '''
+            if not (_NAME.match(username) and _EXTRACT.match(name)):
+                raise LookupError(name)
+            extract = home_dirs / username / name
+            if not extract.exists():
+                raise LookupError(name)
+            path = extract.fullPath()
+            mtime = getmtime(path)
+            with lock:
+                hit = cache.pop(path, None)
+                if hit and hit[0] == mtime:
+                    cache[path] = hit
+                    return hit[1]
+                if hit:
+                    hit[1].dispose()
+                log.info('opening %s', path)
+                db = create_engine(DBURL(drivername=DataDest.drivername),
+                                   creator=read_only(path),
+                                   poolclass=pool.QueuePool)
+                try:
+                    finished = db.execute(
+                        'select max(finished) from job').scalar()
+                except DatabaseError:
+                    db.dispose()
+                    raise
+                if not finished:
+                    db.dispose()
+                    return None
+                cache[path] = (mtime, db)
+                while len(cache) > max_open:
+                    _path, (_mtime, old) = cache.popitem(last=False)
+                    old.dispose()
+                return db
+        self._open = open_extract
+
+    @classmethod
+    def make(cls, config, create_engine, getmtime):
+        '''
+        :param config: lafile.ConfigRd of the Data Builder configuration;
+                       see the optional ``[reader]`` section
+        '''
+        reader = config / 'reader'
+        return cls(config / 'output' / 'home_dirs', create_engine, getmtime,
+                   max_open=int(config_get(reader, 'max_open', 16)),
+                   mmap_size=int(config_get(reader, 'mmap_mb', 256))
+                   * 1024 * 1024)
+
+    def __call__(self, environ, start_response):
+        username = environ.get('REMOTE_USER')
+        parts = environ.get('PATH_INFO', '').strip('/').split('/')
+        params = parse_qs(environ.get('QUERY_STRING', ''))
+        if not username:
+            return self._error(start_response, '403 Forbidden',
+                               'not logged in')
+        if len(parts) != 2 or parts[1] not in self.pages:
+            return self._error(start_response, '404 Not Found',
+                               'expected /<extract>/<%s>' % '|'.join(
+                                   sorted(self.pages)))
+        name, what = parts
+        fmt = params.get('format', ['json'])[0]
+        if fmt not in ('json', 'csv'):
+            return self._error(start_response, '400 Bad Request',
+                               'unknown format: %s' % fmt)
+        try:
+            sql, binds = self.page_query(what, params,
+                                         self.default_limit, self.max_limit)
+        except ValueError as ex:
+            return self._error(start_response, '400 Bad Request', str(ex))
+        try:
+            db = self._open(username, name)
+        except LookupError:
+            return self._error(start_response, '404 Not Found',
+                               'no such extract')
+        except DatabaseError as ex:
+            return self._error(start_response, '400 Bad Request',
+                               'not a readable extract: %s' % ex.orig)
+        if db is None:
+            return self._error(start_response, '409 Conflict',
+                               'extract is not finished')
+
+        log.info('%s: %s/%s %s', username, name, what, sorted(binds.items()))
+        conn = db.connect()
+        try:
+            result = conn.execute(text(sql), **binds)
+        except DatabaseError as ex:
+            conn.close()
+            return self._error(start_response, '400 Bad Request',
+                               'cannot read %s: %s' % (what, ex.orig))
+        except:
+            conn.close()
+            raise
+        if fmt == 'csv':
+            start_response('200 OK', [
+                ('Content-Type', 'text/csv; charset=utf-8')])
+            return self._csv(conn, result)
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return self._json(conn, result, binds['limit'])
+
+    @classmethod
+    def page_query(cls, what, params,
+                   default_limit=100, max_limit=5000):
+        '''Build a query for one page of `what`, given query parameters.
+
+        >>> sql, binds = ExtractReader.page_query('facts', dict(
+        ...     variable=['0', '2'], patient=['5'], end_date=['2010-12-31'],
+        ...     after=['100']))
+        >>> print sql
+        ... # doctest: +NORMALIZE_WHITESPACE
+        select f.rowid row_id, f.* from observation_fact f
+        where f.rowid > :after
+          and f.concept_cd in (
+            select cd.concept_cd from concept_dimension cd
+            join variable v on cd.concept_path like (v.concept_path || '%')
+            where v.id in (:variable_0, :variable_1))
+          and f.patient_num in (:patient_0)
+          and f.start_date < :end_date
+        order by f.rowid limit :limit
+        >>> for k, v in sorted(binds.items()):
+        ...     print k, v
+        after 100
+        end_date 2011-01-01 00:00:00
+        limit 100
+        patient_0 5
+        variable_0 0
+        variable_1 2
+
+        :raises ValueError: for malformed parameters
+        '''
+        table, alias, accepted = cls.pages[what]
+        binds = dict(after=int(params.get('after', [0])[0]),
+                     limit=min(int(params.get('limit', [default_limit])[0]),
+                               max_limit))
+        if binds['limit'] < 1:
+            raise ValueError('limit must be at least 1: %d' % binds['limit'])
+        where = ['%s.rowid > :after' % alias]
+
+        def members(key):
+            names = ['%s_%d' % (key, ix) for ix in range(len(params[key]))]
+            binds.update(zip(names, [int(v) for v in params[key]]))
+            return '(%s)' % ', '.join(':' + n for n in names)
+
+        if 'variable' in accepted and params.get('variable'):
+            if what == 'variables':
+                where.append('v.id in %s' % members('variable'))
+            else:
+                where.append(
+                    '%s.concept_cd in (\n'
+                    '  select cd.concept_cd from concept_dimension cd\n'
+                    '  join variable v on cd.concept_path like'
+                    " (v.concept_path || '%%')\n"
+                    '  where v.id in %s)' % (alias, members('variable')))
+        if 'patient' in accepted and params.get('patient'):
+            where.append('%s.patient_num in %s' % (alias, members('patient')))
+        dates = dict((k, params[k][0]) for k in ('start_date', 'end_date')
+                     if k in accepted and params.get(k))
+        binds.update(DataExtract.filter_binds(dates))
+        if 'start_date' in dates:
+            where.append('%s.start_date >= :start_date' % alias)
+        if 'end_date' in dates:
+            where.append('%s.start_date < :end_date' % alias)
+
+        sql = ('select %(a)s.rowid row_id, %(a)s.* from %(t)s %(a)s\n'
+               'where %(w)s\n'
+               'order by %(a)s.rowid limit :limit' % dict(
+                   a=alias, t=table, w='\n  and '.join(where)))
+        return sql, binds
+
+    @classmethod
+    def _json(cls, conn, result, limit,
+              batch_size=500):
+        try:
+            yield '{"rows": [\n'
+            qty, last = 0, None
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield ('' if qty == 0 else ',\n') + ',\n'.join(
+                    json.dumps(dict(row), sort_keys=True) for row in rows)
+                qty += len(rows)
+                last = rows[-1]['row_id']
+            yield '],\n "next": %s}' % json.dumps(
+                last if qty == limit else None)
+        finally:
+            conn.close()
+
+    @classmethod
+    def _csv(cls, conn, result,
+             batch_size=500):
+        try:
+            buf = StringIO()
+            out = csv.writer(buf, lineterminator='\n')
+            out.writerow(result.keys())
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                out.writerows([[v.encode('utf-8') if isinstance(v, unicode)
+                                else v for v in row] for row in rows])
+                yield buf.getvalue()
+                buf.truncate(0)
+            yield buf.getvalue()
+        finally:
+            conn.close()
+
+    @classmethod
+    def _error(cls, start_response, status, message):
+        start_response(status, [('Content-Type', 'application/json')])
+        return [json.dumps(dict(error=message))]
+
+
+if __name__ == '__main__':
+    def _trusted_main():
+        from __builtin__ import open as openf
+        from ConfigParser import SafeConfigParser
+        from os import environ
+        from wsgiref.handlers import CGIHandler
+        import logging.config
+        import os
+
+        from sqlalchemy.engine import create_engine
+
+        cp = SafeConfigParser()
+        cp.read([environ['DFBUILD_CONFIG']])
+        config = lafile.ConfigRd(
+            cp, lafile.Readable('/', os.path, os.listdir, openf))
+        logging.config.fileConfig((config / 'logging').get('config'),
+                                  disable_existing_loggers=False)
+
+        CGIHandler().run(ExtractReader.make(config, create_engine,
+                                            os.path.getmtime))
+
+    _trusted_main()
@@ -155,6 +155,16 @@ TODO: localize jslint exceptions
 	    if (!/^[A-Za-z0-9\._\-]+$/.test(project_id)) {
 		return this.warn("Please use only letters, digits, period (.), underscore (_) or hyphen (-) in project ID.");
 	    }
+	    var start_date = $j('#start_date').val();
+	    var end_date = $j('#end_date').val();
+	    var latest_n = $j('#latest_n').val();
+	    var isoDate = /^(\d{4}-\d{2}-\d{2})?$/;
+	    if (!isoDate.test(start_date) || !isoDate.test(end_date)) {
+		return this.warn("Please give dates as YYYY-MM-DD.");
+	    }
+	    if (!/^([1-9][0-9]*)?$/.test(latest_n)) {
+		return this.warn("Latest observations must be a whole number.");
+	    }
 	    //var backend = $j('#backend').val();
 	    var backend = 'builder';
 
@@ -166,7 +176,11 @@ TODO: localize jslint exceptions
 		label: this.pw.displayName(this.prs),
 		concepts: concepts_str,
 		filename: filename,
-		project_id: project_id
+		project_id: project_id,
+		start_date: start_date,
+		end_date: end_date,
+		latest_n: latest_n,
+		numeric_only: $j('#numeric_only').is(':checked') ? 1 : ''
 	    };
 	};
 